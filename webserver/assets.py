@@ -0,0 +1,55 @@
+"""
+CSS and JavaScript bundles (Flask-Assets / webassets).
+
+static/css/main.css is minified with rcssmin and the chat page script
+with rjsmin. Each bundle is written to static/gen/ under a name carrying
+its content version, and templates link it through asset_urls('name'), so
+the URL changes whenever the sources do and static_files.py can serve it
+as immutable. If a bundle cannot be built, asset_urls() logs the error and
+links its plain sources instead, so a broken build costs page weight
+rather than every page.
+
+With ASSETS_AUTO_BUILD on (the default) a bundle is rebuilt on the first
+request after a source changes. Production should turn it off and run
+`manage.py build-assets` at deploy, so workers never compile or even stat
+the sources; the versions are then read from the manifest the build wrote.
+"""
+from flask import current_app, url_for
+from flask_assets import Bundle, Environment
+
+
+bundles = {
+  'css_main': Bundle('css/main.css', filters='rcssmin', output='gen/main.%(version)s.css'),
+  'js_chat': Bundle('js/chat.js', filters='rjsmin', output='gen/chat.%(version)s.js'),
+}
+
+
+def asset_urls(name):
+  """The URLs to link for a bundle; its sources if it cannot be built."""
+  bundle = current_app.jinja_env.assets_environment[name]
+  try:
+    return bundle.urls()
+  except Exception:
+    current_app.logger.exception("Could not build the %s bundle", name)
+    return [url_for('static', filename=path) for path in bundle.contents]
+
+
+def init_app(app):
+  app.add_template_global(asset_urls)
+  env = Environment(app)
+  env.manifest = 'file'
+  env.cache = True
+  # The version is in the file name; no ?timestamp as well.
+  env.url_expire = False
+  env.register(bundles)
+  return env
+
+
+def build(app):
+  """Build every bundle; returns the URLs written."""
+  env = app.jinja_env.assets_environment
+  urls = []
+  for name in sorted(bundles):
+    env[name].build(force=True)
+    urls.extend(env[name].urls())
+  return urls
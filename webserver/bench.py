@@ -0,0 +1,363 @@
+"""
+Micro-benchmarks for the webserver. Each command prints its measurements and
+exits non-zero when a budget is exceeded, so it can gate a deploy.
+
+    python3 bench.py startup --budget-ms 1500
+    python3 bench.py ids --threads 32
+    python3 bench.py feed --connections 10000
+    python3 bench.py chat-send USER_A USER_B --threads 16
+    python3 bench.py checkout PRODUCT_NUMBER --threads 16 --stock 200
+    python3 bench.py images --per-page 24
+    python3 bench.py templates --user alice
+"""
+import itertools
+import os
+import sqlite3
+import statistics
+import tempfile
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+
+import chats
+import feed
+import images
+import orders
+import timeline
+from db import get_engine
+from ids import IdAllocator, chat_ids, order_ids, user_ids
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+@click.group()
+def cli():
+  pass
+
+
+@cli.command()
+@click.option('--runs', default=5, help='Number of cold worker boots to time.')
+@click.option('--budget-ms', default=1500, help='Fail if the median boot exceeds this.')
+def startup(runs, budget_ms):
+  """
+  Time a cold import of server.py in a fresh interpreter, which is what a
+  gunicorn worker pays before it can serve. Points DATABASEURI at an
+  unroutable address: any database I/O at import would hang or fail.
+  """
+  env = dict(os.environ, DATABASEURI='postgresql://nobody@192.0.2.1:1/none')
+  timings = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import server'], cwd=here, env=env, check=True, timeout=60)
+    timings.append((time.perf_counter() - start) * 1000)
+  median = statistics.median(timings)
+  print("worker boot: median %.0f ms, max %.0f ms over %d runs (budget %d ms)" % (median, max(timings), runs, budget_ms))
+  if median > budget_ms:
+    sys.exit(1)
+
+
+@cli.command()
+@click.option('--threads', default=32)
+@click.option('--per-thread', default=20000)
+@click.option('--block-size', default=100)
+def ids(threads, per_thread, block_size):
+  """
+  Hammer one IdAllocator from many threads and check every id is unique.
+  Blocks come from an in-process counter standing in for nextval().
+  """
+  blocks = itertools.count(1)
+  reservations = []
+
+  def reserve(sequence):
+    reservations.append(sequence)
+    return next(blocks) * block_size
+
+  allocator = IdAllocator('p', 10, 'post_id_blocks', block_size=block_size, reserve=reserve)
+  results = [None] * threads
+
+  def work(i):
+    results[i] = [allocator.next_id() for _ in range(per_thread)]
+
+  workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+  start = time.perf_counter()
+  for w in workers:
+    w.start()
+  for w in workers:
+    w.join()
+  elapsed = time.perf_counter() - start
+
+  allocated = [id for chunk in results for id in chunk]
+  unique = len(set(allocated))
+  print("%d ids from %d threads in %.2f s (%.0f ids/s), %d block reservations, %d duplicates" % (
+    len(allocated), threads, elapsed, len(allocated) / elapsed, len(reservations), len(allocated) - unique))
+  if unique != len(allocated) or any(len(id) != 10 for id in allocated):
+    sys.exit(1)
+
+
+class SQLiteConn(object):
+  """Just enough of a SQLAlchemy connection to run the feed query on sqlite."""
+
+  def __init__(self, db):
+    self.db = db
+    self.db.row_factory = sqlite3.Row
+
+  def execute(self, sql, *params):
+    return self.db.execute(sql.replace('%s', '?'), params)
+
+
+def timed(fn, runs):
+  timings = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    fn()
+    timings.append((time.perf_counter() - start) * 1000)
+  return statistics.median(timings)
+
+
+@cli.command('feed')
+@click.option('--connections', default=10000)
+@click.option('--posts-per-user', default=5)
+@click.option('--runs', default=20)
+def feed_bench(connections, posts_per_user, runs):
+  """
+  First-page /home latency for one user with many connections: the pull
+  query (run on an in-memory sqlite copy of the schema) against reading a
+  materialized timeline from each store.
+  """
+  db = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+  db.executescript("""
+    CREATE TABLE users (user_id TEXT PRIMARY KEY, username TEXT, email TEXT, name TEXT);
+    CREATE TABLE posts (post_id TEXT PRIMARY KEY, post_type TEXT, post_content TEXT, user_id TEXT,
+                        privacy_type TEXT, date_time timestamp);
+    CREATE TABLE connected_to (user_id TEXT, connection TEXT, PRIMARY KEY (user_id, connection));
+    CREATE INDEX posts_user_date_idx ON posts (user_id, date_time DESC, post_id DESC);
+  """)
+  start = datetime(2021, 1, 1)
+  users = ['me'] + ['f%06d' % i for i in range(connections)]
+  db.executemany("INSERT INTO users VALUES (?, ?, '', ?)", [(u, u, u.upper()) for u in users])
+  db.executemany("INSERT INTO connected_to VALUES ('me', ?)", [(u,) for u in users[1:]])
+  db.executemany("INSERT INTO posts VALUES (?, 'status', 'hello', ?, 'public', ?)", [
+    ('p%s%d' % (u, n), u, start + timedelta(minutes=i * posts_per_user + n))
+    for i, u in enumerate(users) for n in range(posts_per_user)])
+  conn = SQLiteConn(db)
+  limit = 20
+
+  pull = timed(lambda: feed.load_feed(conn, 'me', limit=limit), runs)
+  print("pull   %8.2f ms  (%d connections, %d posts)" % (pull, connections, len(users) * posts_per_user))
+
+  posts, _ = feed.load_feed(conn, 'me', limit=500)
+  stores = [('memory', timeline.MemoryTimelineStore(500)),
+            ('sqlite', timeline.SQLiteTimelineStore(os.path.join(tempfile.mkdtemp(), 'timelines.sqlite3'), 500))]
+  for name, store in stores:
+    store.fill('me', posts)
+    push = timed(lambda: timeline.read_feed(conn, store, 'me', limit=limit), runs)
+    print("%-6s %8.2f ms  (%.0fx)" % (name, push, pull / push if push else float('inf')))
+
+
+@cli.command('chat-send')
+@click.argument('user_a')
+@click.argument('user_b')
+@click.option('--threads', default=16)
+@click.option('--per-thread', default=50)
+def chat_send(user_a, user_b, threads, per_thread):
+  """
+  Concurrent sends into one room on the database at DATABASEURI (use a
+  scratch database). Opens a new room between two existing users, has
+  every thread send into it at once, and fails if any message_id is
+  duplicated or missing.
+  """
+  from server import app
+
+  with app.app_context():
+    engine = get_engine()
+    room_id = chat_ids.next_id()
+    with engine.connect() as conn:
+      chats.create_room(conn, room_id, user_a, user_b, 'bench', datetime.now())
+
+    def work(i):
+      with engine.connect() as conn:
+        for n in range(per_thread):
+          chats.send(conn, room_id, user_a if n % 2 else user_b, 'bench %d/%d' % (i, n), datetime.now())
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+      w.start()
+    for w in workers:
+      w.join()
+    elapsed = time.perf_counter() - start
+
+    with engine.connect() as conn:
+      ids = [r[0] for r in conn.execute("SELECT message_id FROM chat WHERE session_id = (%s) ORDER BY message_id", room_id)]
+      last = conn.execute("SELECT last_message_id FROM chat_rooms WHERE session_id = (%s)", room_id).scalar()
+
+  expected = list(range(1, threads * per_thread + 2))
+  print("%d sends from %d threads in %.2f s (%.0f sends/s), room %s" % (
+    threads * per_thread, threads, elapsed, threads * per_thread / elapsed, room_id))
+  if ids != expected or last != expected[-1]:
+    print("message ids are not 1..%d without gaps or duplicates" % expected[-1])
+    sys.exit(1)
+
+
+@cli.command()
+@click.argument('product_number')
+@click.option('--threads', default=16, help='Concurrent shoppers, one bench user each.')
+@click.option('--per-thread', default=20, help='Checkouts each shopper attempts.')
+@click.option('--stock', default=200, help='Stock to give the product before the run.')
+def checkout(product_number, threads, per_thread, stock):
+  """
+  Concurrent checkouts of one hot product on the database at DATABASEURI
+  (use a scratch database). Creates a bench user per thread; every thread
+  repeatedly puts one unit in its cart and checks out. Fails unless exactly
+  min(attempts, stock) orders went through, stock went down by that much,
+  and every order has its line.
+  """
+  from server import app
+
+  with app.app_context():
+    engine = get_engine()
+    shoppers = [user_ids.next_id() for _ in range(threads)]
+    address = {'street_1': 'bench', 'street_2': '', 'city': 'bench', 'state': 'NY', 'zip': '00000'}
+    with engine.connect() as conn:
+      for user_id in shoppers:
+        conn.execute("INSERT INTO users VALUES (%s, %s, %s, %s)", user_id, 'bench' + user_id, user_id + '@bench', 'bench')
+      original = conn.execute("SELECT stock FROM products WHERE product_number = (%s)", product_number).scalar()
+      conn.execute("UPDATE products SET stock = (%s) WHERE product_number = (%s)", stock, product_number)
+
+    # Allocated up front: next_id() needs the app context this thread holds.
+    order_numbers = [[order_ids.next_id() for _ in range(per_thread)] for _ in range(threads)]
+    refused = [0] * threads
+
+    def work(i):
+      with engine.connect() as conn:
+        for n in range(per_thread):
+          conn.execute("""INSERT INTO has_in_cart VALUES (%s, %s, 1)
+                          ON CONFLICT (user_id, product_number) DO UPDATE SET quantity = 1""", shoppers[i], product_number)
+          try:
+            orders.place_order(conn, order_numbers[i][n], shoppers[i], datetime.now(), address)
+          except orders.OrderError:
+            refused[i] += 1
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+      w.start()
+    for w in workers:
+      w.join()
+    elapsed = time.perf_counter() - start
+
+    with engine.connect() as conn:
+      placed = conn.execute("SELECT COUNT(*) FROM orders WHERE user_id = ANY(%(shoppers)s)",
+                            {'shoppers': shoppers}).scalar()
+      lines = conn.execute("""SELECT COUNT(*) FROM orders O JOIN contains_item C ON C.order_number = O.order_number
+                              WHERE O.user_id = ANY(%(shoppers)s) AND C.product_number = %(product_number)s""",
+                           {'shoppers': shoppers, 'product_number': product_number}).scalar()
+      left = conn.execute("SELECT stock FROM products WHERE product_number = (%s)", product_number).scalar()
+      conn.execute("UPDATE products SET stock = (%s) WHERE product_number = (%s)", original, product_number)
+
+  attempts = threads * per_thread
+  expected = min(attempts, stock)
+  print("%d checkouts from %d threads in %.2f s (%.0f/s): %d placed, %d refused, stock %d -> %d" % (
+    attempts, threads, elapsed, attempts / elapsed, placed, sum(refused), stock, left))
+  if placed != expected or lines != expected or left != stock - expected or placed + sum(refused) != attempts:
+    print("expected %d orders with one line each and %d stock left" % (expected, stock - expected))
+    sys.exit(1)
+
+
+@cli.command('images')
+@click.option('--per-page', default=24, help='Products on one listing page.')
+def images_bench(per_page):
+  """
+  Image bytes a browser downloads for a listing page and an item page:
+  the original files against the derivatives the pages now point at
+  ('listing' for listings, 'detail' for item pages). Derivatives go to a
+  scratch IMAGE_CACHE_DIR.
+  """
+  from server import app
+
+  names = sorted(n for n in os.listdir(images.originals_dir) if '.' not in n)
+  listing = list(itertools.islice(itertools.cycle(names), per_page))
+  app.config['IMAGE_CACHE_DIR'] = tempfile.mkdtemp(prefix='amabook-images-')
+  with app.test_request_context():
+    start = time.perf_counter()
+    sizes = {(n, v): os.path.getsize(images.derivative(n, v)) for n in names for v in images.VARIANTS}
+    elapsed = time.perf_counter() - start
+
+  original = {n: os.path.getsize(images.original_path(n)) for n in names}
+  print("%d originals, %d derivatives made in %.2f s" % (len(names), len(sizes), elapsed))
+  print("%-22s %10s %10s" % ('', 'before', 'after'))
+  rows = [('listing page (%d)' % per_page, sum(original[n] for n in listing), sum(sizes[n, 'listing'] for n in listing)),
+          ('item page (avg)', sum(original.values()) / len(names), sum(sizes[n, 'detail'] for n in names) / len(names))]
+  for label, before, after in rows:
+    print("%-22s %8.0f KB %8.0f KB  (%.0f%% smaller)" % (label, before / 1024, after / 1024, 100 - 100.0 * after / before))
+
+
+@cli.command('templates')
+@click.option('--user', default='alice', help='Username to log in as for the signed-in pages.')
+@click.option('--runs', default=50)
+def templates_bench(user, runs):
+  """
+  Template cost, cold and warm. Per template: compiling from source (a
+  worker without the bytecode cache), loading from the bytecode cache, and
+  the lookup every later render does, with and without the auto-reload
+  check. Per page: the first request of a worker that has not loaded its
+  templates yet, with and without the bytecode cache, against the steady
+  state. Pages are requested once before timing, so the database and the
+  data caches are warm and the differences are the templates'.
+  """
+  from server import app
+  import templating
+
+  env = app.jinja_env
+  bytecode_cache = env.bytecode_cache or templating.SharedBytecodeCache(tempfile.mkdtemp(prefix='amabook-templates-'))
+  names = templating.precompile(app)
+  cold = env.overlay(cache_size=0, bytecode_cache=None)
+  from_cache = env.overlay(cache_size=0, bytecode_cache=bytecode_cache)
+  reloading = env.overlay(auto_reload=True)
+  steady = env.overlay(auto_reload=False)
+  for name in names:
+    from_cache.get_template(name)
+    reloading.get_template(name)
+    steady.get_template(name)
+
+  print("%-18s %10s %10s %12s %12s" % ('template', 'compile', 'bytecode', 'get+reload', 'get'))
+  for name in names:
+    print("%-18s %7.2f ms %7.2f ms %9.4f ms %9.4f ms" % (
+      name,
+      timed(lambda: cold.get_template(name), 5),
+      timed(lambda: from_cache.get_template(name), 5),
+      timed(lambda: reloading.get_template(name), runs),
+      timed(lambda: steady.get_template(name), runs)))
+
+  with app.app_context():
+    conn = get_engine().connect()
+    item_type = conn.execute("SELECT item_type FROM products WHERE item_type IS NOT NULL LIMIT 1").scalar()
+    product_number = conn.execute("SELECT product_number FROM products LIMIT 1").scalar()
+    conn.close()
+  client = app.test_client()
+  client.post('/login', data={'username': user})
+  pages = ['/home', '/profile', '/cart', '/chat', '/category/%s' % item_type, '/item/%s' % product_number]
+
+  def first_request(url, cache):
+    env.cache.clear()
+    env.bytecode_cache = cache
+    start = time.perf_counter()
+    client.get(url)
+    return (time.perf_counter() - start) * 1000
+
+  print()
+  print("%-24s %14s %14s %10s" % ('page', 'first (cold)', 'first (cache)', 'steady'))
+  for url in pages:
+    client.get(url)
+    compiled = first_request(url, None)
+    cached = first_request(url, bytecode_cache)
+    print("%-24s %11.1f ms %11.1f ms %7.1f ms" % (url, compiled, cached, timed(lambda: client.get(url), runs)))
+
+
+if __name__ == "__main__":
+  cli()
@@ -0,0 +1,97 @@
+"""
+In-process caches.
+
+LRUCache is a bounded, thread-safe least-recently-used map whose entries
+expire after a TTL (the cache's, or one given to set()). It counts hits,
+misses and evictions. Every cache built through make_cache() is
+registered by name, and /cache_status reports their counters.
+
+A cache setting is 'off', 'memory' (an LRUCache in this worker) or
+'module:Class' for a shared store with the same get/set/delete/clear/stats
+methods (set taking an optional ttl); the class is called with
+(max_size, ttl).
+"""
+import importlib
+import threading
+import time
+from collections import OrderedDict
+
+
+_missing = object()
+
+
+class LRUCache(object):
+  """At most max_size entries, each dropped ttl seconds after it was set."""
+
+  def __init__(self, max_size, ttl):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()    # key -> (expires, value), oldest first
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key, default=None):
+    with self.lock:
+      entry = self.entries.get(key, _missing)
+      if entry is not _missing and entry[0] < time.monotonic():
+        del self.entries[key]
+        entry = _missing
+      if entry is _missing:
+        self.misses += 1
+        return default
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def set(self, key, value, ttl=None):
+    with self.lock:
+      self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def delete(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        'size': len(self.entries),
+        'max_size': self.max_size,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': self.hits / lookups if lookups else None,
+      }
+
+
+caches = {}
+_lock = threading.Lock()
+
+
+def make_cache(name, kind, max_size, ttl):
+  """Build and register the cache `name`, or return None when kind is 'off'."""
+  if kind == 'off':
+    return None
+  if kind == 'memory':
+    cache = LRUCache(max_size, ttl)
+  else:
+    module, cls = kind.split(':')
+    cache = getattr(importlib.import_module(module), cls)(max_size, ttl)
+  with _lock:
+    caches[name] = cache
+  return cache
+
+
+def status():
+  with _lock:
+    return {name: cache.stats() for name, cache in caches.items()}
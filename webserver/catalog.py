@@ -0,0 +1,252 @@
+"""
+Product catalog reads for /item, /category and /brand.
+
+Products are read as Product records (named fields) joined to the seller's
+user row. Item pages are addressed by product_number; load_item() only
+resolves the old name/color URLs to one. The catalog is read-mostly, so
+with CATALOG_CACHE on, each product lookup and each category or brand
+listing is kept in an LRU with a TTL (see cache.py) and served from there
+until it expires or the catalog is invalidated. Listings are GET pages
+(/category/<item_type>, /brand/<seller>) sorted by name, price, rating or
+newest and cut with a keyset, so every page costs the same and each page
+is cached on its own.
+The navigation menus on every page list the categories and brands from a
+copy kept in each process and reloaded every CATALOG_FACETS_TTL seconds;
+if a reload fails the menus keep the last copy (or are empty until the
+first load works), so no page fails because of them.
+
+Stock is left out of the records: it changes with every order, is checked
+against the database at checkout, and would otherwise force an
+invalidation per order. Writes that change anything else about a product
+must call invalidate_catalog(). Review counts (from review_summaries) in
+cached listings may lag by up to CATALOG_CACHE_TTL; the item page's rating
+is refreshed by every review written through this worker.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+
+import fragments
+from cache import make_cache
+from db import decode_cursor, encode_cursor, get_engine
+
+
+Product = namedtuple('Product', [
+  'product_number', 'name', 'color', 'price', 'description', 'on_sale', 'available',
+  'item_type', 'size', 'discount_price', 'sold_by', 'seller_username', 'seller_name',
+  'reviews_up', 'reviews_total',
+])
+
+product_columns = """
+  P.product_number, P.name, P.color, P.price, P.description, P.on_sale, P.available,
+  P.item_type, P.size, P.discount_price, P.sold_by,
+  U.username AS seller_username, U.name AS seller_name,
+  COALESCE(R.up_count, 0), COALESCE(R.total, 0)
+"""
+
+product_query = """
+  SELECT {columns}
+  FROM products P JOIN users U ON U.user_id = P.sold_by
+    LEFT JOIN review_summaries R ON R.product_number = P.product_number
+  WHERE {where}
+  ORDER BY P.name, P.product_number
+"""
+
+# Listing sort orders: the sort key expression and its direction. The
+# expressions match the indexes of migration 0010 (except rating, which
+# comes from review_summaries and is sorted within the category or brand).
+SORTS = {
+  'name': ("P.name", 'ASC'),
+  'price': ("COALESCE(P.price, 0)", 'ASC'),
+  'rating': ("COALESCE(R.up_count::real / NULLIF(R.total, 0), -1)", 'DESC'),
+  'newest': ("P.listed_at", 'DESC'),
+}
+
+# One page of a category or brand, cut with a (sort key, product_number) keyset.
+listing_query = """
+  SELECT {columns}, {key} AS sort_key
+  FROM products P JOIN users U ON U.user_id = P.sold_by
+    LEFT JOIN review_summaries R ON R.product_number = P.product_number
+  WHERE P.{column} = (%s) {keyset}
+  ORDER BY {key} {direction}, P.product_number {direction}
+  LIMIT %s
+"""
+
+
+def query_products(conn, where, *params):
+  cursor = conn.execute(product_query.format(columns=product_columns, where=where), *params)
+  products = [Product(*row) for row in cursor]
+  cursor.close()
+  return products
+
+
+def load_product(conn, product_number):
+  """The product with this product_number (a primary-key lookup), or None."""
+  products = query_products(conn, "P.product_number = (%s)", product_number)
+  return products[0] if products else None
+
+
+def load_item(conn, name, color=None):
+  """The product called name (in that color, if given), or None."""
+  if color:
+    products = query_products(conn, "P.name = (%s) AND P.color = (%s)", name, color)
+  else:
+    products = query_products(conn, "P.name = (%s)", name)
+  return products[0] if products else None
+
+
+def load_listing(conn, column, value, sort='name', after=None, limit=24):
+  """
+  One page of the products whose column (item_type or sold_by) is value,
+  in the given sort order, starting after the cursor `after`. Returns
+  (products, next_cursor); next_cursor is None on the last page.
+  """
+  key, direction = SORTS.get(sort, SORTS['name'])
+  params = [value]
+  keyset = ''
+  position = decode_cursor(after)
+  if position:
+    keyset = "AND ({key}, P.product_number) {op} (%s, %s)".format(key=key, op='>' if direction == 'ASC' else '<')
+    params.extend(position)
+  params.append(limit + 1)
+
+  cursor = conn.execute(listing_query.format(columns=product_columns, key=key, column=column,
+                                             keyset=keyset, direction=direction), *params)
+  rows = cursor.fetchall()
+  cursor.close()
+
+  next_cursor = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1]['sort_key'], rows[-1]['product_number'])
+  return [Product(*row[:-1]) for row in rows], next_cursor
+
+
+def load_category(conn, item_type, sort='name', after=None, limit=24):
+  return load_listing(conn, 'item_type', item_type, sort, after, limit)
+
+
+def load_brand(conn, seller, sort='name', after=None, limit=24):
+  """
+  (seller's name, products, next_cursor) for one page of a seller's
+  products; the name is None for an unknown seller.
+  """
+  cursor = conn.execute("SELECT name FROM users WHERE user_id = (%s)", seller)
+  name = cursor.scalar()
+  cursor.close()
+  return (name,) + load_listing(conn, 'sold_by', seller, sort, after, limit)
+
+
+_catalog_cache = None
+_catalog_cache_lock = threading.Lock()
+
+
+def get_catalog_cache():
+  """This process's catalog cache, or None when CATALOG_CACHE is 'off'."""
+  global _catalog_cache
+  config = current_app.config
+  if config['CATALOG_CACHE'] == 'off':
+    return None
+  if _catalog_cache is None:
+    with _catalog_cache_lock:
+      if _catalog_cache is None:
+        _catalog_cache = make_cache('catalog', config['CATALOG_CACHE'],
+                                    config['CATALOG_CACHE_SIZE'], config['CATALOG_CACHE_TTL'])
+  return _catalog_cache
+
+
+def cached(key, load):
+  cache = get_catalog_cache()
+  if cache is None:
+    return load()
+  value = cache.get(key)
+  if value is None:
+    value = load()
+    cache.set(key, value)
+  return value
+
+
+def product(conn, product_number):
+  return cached(('product', product_number), lambda: load_product(conn, product_number))
+
+
+def item(conn, name, color=None):
+  return cached(('item', name, color or None), lambda: load_item(conn, name, color))
+
+
+def category(conn, item_type, sort='name', after=None, limit=24):
+  return cached(('category', item_type, sort, after, limit),
+                lambda: load_category(conn, item_type, sort, after, limit))
+
+
+def brand(conn, seller, sort='name', after=None, limit=24):
+  return cached(('brand', seller, sort, after, limit),
+                lambda: load_brand(conn, seller, sort, after, limit))
+
+
+def load_facets(conn):
+  """
+  Navigation facets: every item_type and every retailer, each with its
+  number of products.
+  """
+  cursor = conn.execute("""
+    SELECT item_type, COUNT(*) AS products FROM products
+    WHERE item_type IS NOT NULL
+    GROUP BY item_type ORDER BY item_type""")
+  categories = cursor.fetchall()
+  cursor.close()
+  cursor = conn.execute("""
+    SELECT R.user_id, U.name, COUNT(P.product_number) AS products
+    FROM retailers R JOIN users U ON U.user_id = R.user_id
+      LEFT JOIN products P ON P.sold_by = R.user_id
+    GROUP BY R.user_id, U.name ORDER BY U.name""")
+  brands = cursor.fetchall()
+  cursor.close()
+  return {'categories': categories, 'brands': brands}
+
+
+no_facets = {'categories': [], 'brands': []}
+_facets = None
+_facets_expires = 0.0
+_facets_lock = threading.Lock()
+
+
+def facets():
+  """
+  The navigation facets, reloaded when CATALOG_FACETS_TTL has passed. One
+  thread reloads while the others keep serving the old copy; a failed
+  reload keeps the old copy (no_facets before the first load) and is
+  retried after the same interval.
+  """
+  global _facets, _facets_expires
+  if time.monotonic() >= _facets_expires and _facets_lock.acquire(blocking=_facets is None):
+    try:
+      if time.monotonic() >= _facets_expires:
+        try:
+          # Its own connection, back in the pool at once: the page being
+          # rendered (maybe /, which never queries) does not keep one.
+          with get_engine().connect() as conn:
+            _facets = load_facets(conn)
+        except Exception:
+          current_app.logger.exception("Could not load the catalog facets")
+        _facets_expires = time.monotonic() + current_app.config['CATALOG_FACETS_TTL']
+    finally:
+      _facets_lock.release()
+  return _facets if _facets is not None else no_facets
+
+
+def init_app(app):
+  # For the navigation menus in layout.html; only read when it is rendered.
+  app.context_processor(lambda: {'catalog_facets': facets})
+
+
+def invalidate_catalog():
+  """Drop every cached product, listing and catalog fragment; call after writing products."""
+  global _facets_expires
+  _facets_expires = 0.0
+  cache = get_catalog_cache()
+  if cache is not None:
+    cache.clear()
+  fragments.invalidate('catalog')
@@ -0,0 +1,155 @@
+"""
+Chat rooms and the message inbox.
+
+chat_rooms (migration 0005) keeps one summary row per chat session: the two
+participants and the last message. It is written whenever a room is
+created or a message is sent, so the inbox reads one row per room the user
+is in instead of scanning the whole chat table.
+"""
+from db import transaction
+
+
+# Latest message of every session a user takes part in, straight from chat.
+# Used to (re)build chat_rooms; the migration runs the same query unscoped.
+latest_messages_query = """
+  SELECT DISTINCT ON (M.session_id)
+         M.session_id, M.sender, M.recipient, M.message_id, M.content, M.date_time
+  FROM chat M
+  WHERE M.session_id IN (SELECT session_id FROM chat WHERE sender = (%s) OR recipient = (%s))
+  ORDER BY M.session_id, M.message_id DESC
+"""
+
+
+def load_inbox(conn, user_id, active=None):
+  """One entry per room user_id is in, most recently active first."""
+  cursor = conn.execute("""
+    SELECT R.session_id, R.last_content, R.last_date_time, U.username
+    FROM chat_rooms R
+      JOIN users U ON U.user_id = CASE WHEN R.user_a = (%s) THEN R.user_b ELSE R.user_a END
+    WHERE R.user_a = (%s) OR R.user_b = (%s)
+    ORDER BY R.last_date_time DESC NULLS LAST, R.session_id""", user_id, user_id, user_id)
+  data = []
+  for row in cursor:
+    data.append(
+      {
+        "username":row['username'],
+        "room_id":row['session_id'],
+        "active":row['session_id'] == active,
+        "last_message":row['last_content'] or "No messages...",
+      }
+    )
+  cursor.close()
+  return data
+
+
+def find_room(conn, user_id, other_id):
+  """The session_id of the existing room between two users, or None."""
+  cursor = conn.execute("""
+    SELECT session_id FROM chat_rooms
+    WHERE (user_a = (%s) AND user_b = (%s)) OR (user_a = (%s) AND user_b = (%s))
+    LIMIT 1""", user_id, other_id, other_id, user_id)
+  room = cursor.scalar()
+  cursor.close()
+  return room
+
+
+def create_room(conn, room_id, sender, recipient, content, date):
+  """Open a room with its first message and its summary row."""
+  with transaction(conn):
+    conn.execute("INSERT INTO chat VALUES (%s, %s, %s, %s, %s, %s)", room_id, 1, date, content, sender, recipient)
+    conn.execute("""INSERT INTO chat_rooms (session_id, user_a, user_b, last_message_id, last_content, last_sender, last_date_time)
+                    VALUES (%s, %s, %s, 1, %s, %s, %s)""", room_id, sender, recipient, content, sender, date)
+
+
+def send(conn, room_id, sender, content, date):
+  """
+  Append a message to a room in one statement and return the stored row,
+  or None if the room does not exist or sender is not in it.
+
+  The UPDATE on the room's chat_rooms row takes its row lock and bumps the
+  room's message counter, so concurrent senders are serialized on that one
+  row and each gets the next message_id; the summary is updated in the
+  same statement.
+  """
+  with transaction(conn):
+    cursor = conn.execute("""
+    WITH room AS (
+      UPDATE chat_rooms
+      SET last_message_id = last_message_id + 1, last_content = %s, last_sender = %s, last_date_time = %s
+      WHERE session_id = %s AND (user_a = %s OR user_b = %s)
+      RETURNING session_id, last_message_id, CASE WHEN user_a = %s THEN user_b ELSE user_a END AS recipient
+    )
+    INSERT INTO chat (session_id, message_id, date_time, content, sender, recipient)
+    SELECT session_id, last_message_id, %s, %s, %s, recipient FROM room
+    RETURNING *""", content, sender, date, room_id, sender, sender, sender, date, content, sender)
+    row = cursor.fetchone()
+    cursor.close()
+  return row
+
+
+def message_dict(row):
+  """A chat row as the JSON the browser receives (pages and live pushes)."""
+  return {
+    'room_id': row['session_id'],
+    'message_id': row['message_id'],
+    'sender': row['sender'],
+    'content': row['content'],
+    'date_time': str(row['date_time']),
+  }
+
+
+# A room's messages for one of its participants, cut with a message_id keyset.
+history_query = """
+  SELECT M.session_id, M.message_id, M.date_time, M.content, M.sender
+  FROM chat M JOIN chat_rooms R ON R.session_id = M.session_id
+  WHERE M.session_id = (%s) AND (R.user_a = (%s) OR R.user_b = (%s)) {keyset}
+  ORDER BY M.message_id {order}
+  LIMIT %s
+"""
+
+
+def load_history(conn, room_id, user_id, before=None, limit=50):
+  """
+  The latest page of a room's messages (or the page before message_id
+  `before`), oldest first, for a participant. Returns (messages,
+  older_cursor); older_cursor is None once the start of the room is reached.
+  """
+  params = [room_id, user_id, user_id]
+  keyset = ''
+  if before is not None:
+    keyset = "AND M.message_id < (%s)"
+    params.append(before)
+  params.append(limit + 1)
+  cursor = conn.execute(history_query.format(keyset=keyset, order='DESC'), *params)
+  messages = [message_dict(row) for row in cursor]
+  cursor.close()
+
+  older = None
+  if len(messages) > limit:
+    messages = messages[:limit]
+    older = messages[-1]['message_id']
+  messages.reverse()
+  return messages, older
+
+
+def load_since(conn, room_id, user_id, since, limit=200):
+  """Messages after message_id `since`, oldest first (at most limit)."""
+  cursor = conn.execute(history_query.format(keyset="AND M.message_id > (%s)", order='ASC'),
+                        room_id, user_id, user_id, since, limit)
+  messages = [message_dict(row) for row in cursor]
+  cursor.close()
+  return messages
+
+
+def rebuild_rooms(conn, user_id):
+  """Rewrite the chat_rooms rows of every session user_id takes part in."""
+  with transaction(conn):
+    conn.execute("""
+      INSERT INTO chat_rooms (session_id, user_a, user_b, last_message_id, last_content, last_sender, last_date_time)
+      SELECT L.session_id, L.sender, L.recipient, L.message_id, L.content, L.sender, L.date_time
+      FROM ({latest}) L
+      ON CONFLICT (session_id) DO UPDATE SET
+        last_message_id = EXCLUDED.last_message_id,
+        last_content = EXCLUDED.last_content,
+        last_sender = EXCLUDED.last_sender,
+        last_date_time = EXCLUDED.last_date_time""".format(latest=latest_messages_query), user_id, user_id)
@@ -0,0 +1,136 @@
+"""
+Database engine and connection pool.
+
+The engine is built lazily from the app config the first time a connection
+is needed, once per process, so gunicorn workers never share pooled sockets
+that were opened before the fork.
+
+Routes call get_conn() instead of touching the engine directly. The first
+call in a request checks a connection out of the pool and later calls reuse
+it; requests that never query the database never take a connection.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+from flask import current_app, g
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool, QueuePool
+
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+
+def pool_size(config):
+  """
+  Per-worker pool size: DB_POOL_SIZE if set, otherwise an even share of
+  DB_MAX_CONNECTIONS (minus the overflow each worker may add on top).
+  """
+  if config['DB_POOL_SIZE']:
+    return config['DB_POOL_SIZE']
+  workers = max(1, config['WEB_CONCURRENCY'])
+  share = config['DB_MAX_CONNECTIONS'] // workers - config['DB_MAX_OVERFLOW']
+  return max(1, share)
+
+
+def make_engine(config):
+  if config['DB_POOL'] == 'null':
+    return create_engine(config['DATABASEURI'], poolclass=NullPool, echo=config['DB_ECHO'])
+  return create_engine(
+    config['DATABASEURI'],
+    poolclass=QueuePool,
+    pool_size=pool_size(config),
+    max_overflow=config['DB_MAX_OVERFLOW'],
+    pool_timeout=config['DB_POOL_TIMEOUT'],
+    pool_recycle=config['DB_POOL_RECYCLE'],
+    pool_pre_ping=config['DB_POOL_PRE_PING'],
+    echo=config['DB_ECHO'],
+  )
+
+
+def get_engine():
+  """Return this process's engine, creating it on first use (or after a fork)."""
+  global _engine, _engine_pid
+  if _engine is None or _engine_pid != os.getpid():
+    with _engine_lock:
+      if _engine is None or _engine_pid != os.getpid():
+        _engine = make_engine(current_app.config)
+        _engine_pid = os.getpid()
+  return _engine
+
+
+def get_conn():
+  """Check out a connection for the current request on first use."""
+  if 'conn' not in g:
+    g.conn = get_engine().connect()
+  return g.conn
+
+
+def close_conn(exception=None):
+  """
+  At the end of the web request, return the connection to the pool (if the
+  request took one at all).
+  """
+  conn = g.pop('conn', None)
+  if conn is not None:
+    try:
+      conn.close()
+    except Exception:
+      pass
+
+
+@contextmanager
+def transaction(conn):
+  """
+  Run the block in one transaction on conn, committed at the end. Needed
+  for statements that write but start with WITH (or SELECT): the engine
+  only autocommits statements that start with INSERT, UPDATE, DELETE and
+  the like, and would roll the others back when the connection goes back
+  to the pool.
+  """
+  with conn.begin():
+    yield conn
+
+
+def encode_cursor(key, id):
+  """
+  A keyset position as '<sort key>_<id>' for the ?before=/?after= of a
+  paginated page. Dates and times are written as ISO, floats exactly.
+  """
+  if isinstance(key, float):
+    key = repr(key)
+  elif hasattr(key, 'isoformat'):
+    key = key.isoformat()
+  return "%s_%s" % (key, id)
+
+
+def decode_cursor(cursor):
+  """Return (sort key, id) from a cursor, or None if it is malformed."""
+  key, sep, id = (cursor or '').rpartition('_')
+  if not sep or not key or not id:
+    return None
+  return key, id
+
+
+def pool_status():
+  """Snapshot of the pool counters for this worker."""
+  stats = {'pid': os.getpid(), 'engine': _engine is not None and _engine_pid == os.getpid()}
+  if not stats['engine']:
+    return stats
+  pool = _engine.pool
+  stats['pool'] = type(pool).__name__
+  if isinstance(pool, QueuePool):
+    stats.update(
+      size=pool.size(),
+      checked_in=pool.checkedin(),
+      checked_out=pool.checkedout(),
+      overflow=pool.overflow(),
+      timeout=pool.timeout(),
+    )
+  return stats
+
+
+def init_app(app):
+  app.teardown_appcontext(close_conn)
@@ -0,0 +1,57 @@
+"""
+News feed for /home.
+
+The feed is a single query: the user's own posts plus the public posts of
+everyone they are connected to, joined to users for the author names and
+ordered newest first. Pages are cut with a (date_time, post_id) keyset
+instead of OFFSET, so every page costs the same no matter how far back the
+user scrolls; posts_user_date_idx (migration 0003) serves each author's
+slice in order.
+"""
+from db import decode_cursor, encode_cursor
+
+
+feed_query = """
+  SELECT P.post_id, P.post_type, P.post_content, P.user_id, P.privacy_type, P.date_time,
+         U.username, U.name
+  FROM posts P JOIN users U ON U.user_id = P.user_id
+  WHERE (P.user_id = %s
+         OR (P.privacy_type = 'public'
+             AND P.user_id IN (SELECT C.connection FROM connected_to C WHERE C.user_id = %s)))
+    {keyset}
+  ORDER BY P.date_time DESC, P.post_id DESC
+  LIMIT %s
+"""
+
+
+def load_feed(conn, user_id, before=None, limit=20):
+  """
+  One page of user_id's feed, newest first, starting after the cursor
+  `before`. Returns (posts, next_cursor); next_cursor is None on the last
+  page.
+  """
+  params = [user_id, user_id]
+  keyset = ''
+  position = decode_cursor(before)
+  if position:
+    keyset = "AND (P.date_time, P.post_id) < (%s, %s)"
+    params.extend(position)
+  # One extra row tells us whether there is another page.
+  params.append(limit + 1)
+
+  cursor = conn.execute(feed_query.format(keyset=keyset), *params)
+  posts = [dict(row) for row in cursor]
+  cursor.close()
+
+  next_cursor = None
+  if len(posts) > limit:
+    posts = posts[:limit]
+    next_cursor = encode_cursor(posts[-1]['date_time'], posts[-1]['post_id'])
+  return posts, next_cursor
+
+
+def has_connections(conn, user_id):
+  cursor = conn.execute("SELECT EXISTS (SELECT 1 FROM connected_to WHERE user_id = (%s))", user_id)
+  exists = cursor.scalar()
+  cursor.close()
+  return exists
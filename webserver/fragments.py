@@ -0,0 +1,122 @@
+"""
+Fragment caching for templates.
+
+A block wrapped in
+
+    {% cache key, ttl, tags %} ... {% endcache %}
+
+is rendered once and then served as HTML from the fragment cache (an
+LRUCache, see cache.py) until ttl seconds pass or one of its tags is
+invalidated. ttl and tags may be left out (or ttl given as none) to use
+FRAGMENT_CACHE_TTL and no tags. The key must say everything the block's
+output depends on, e.g. the user for a block that shows their own
+buttons; the template and line of the block are added to it, so two
+blocks may use the same key.
+
+Routes that write call invalidate(tag...) for what they changed
+('reviews:<product_number>', 'friends:<user_id>', 'catalog'). Each tag
+has a random token in the cache, every fragment key includes the tokens
+of its tags, and invalidating a tag replaces its token, so the old
+fragments are never looked up again and age out of the LRU. With the
+'memory' cache this is per worker: other workers serve their copy until
+its ttl runs out, so blocks that show a user's own writes keep short ttls
+unless FRAGMENT_CACHE is a shared store. A block drawn from data that is
+cached elsewhere (a product card from a catalog listing) puts the values
+it shows in its key instead: invalidating a tag would only render the
+same stale data again.
+
+To skip the queries as well as the rendering on a hit, routes pass the
+data of a cached block as a function that the block calls.
+"""
+import threading
+import uuid
+
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from cache import make_cache
+
+
+_fragment_cache = None
+_fragment_cache_lock = threading.Lock()
+
+
+def get_fragment_cache():
+  """This process's fragment cache, or None when FRAGMENT_CACHE is 'off'."""
+  global _fragment_cache
+  config = current_app.config
+  if config['FRAGMENT_CACHE'] == 'off':
+    return None
+  if _fragment_cache is None:
+    with _fragment_cache_lock:
+      if _fragment_cache is None:
+        _fragment_cache = make_cache('fragments', config['FRAGMENT_CACHE'],
+                                     config['FRAGMENT_CACHE_SIZE'], config['FRAGMENT_CACHE_TTL'])
+  return _fragment_cache
+
+
+def freeze(key):
+  """key with its lists made into tuples, so it can be a cache key."""
+  if isinstance(key, (list, tuple)):
+    return tuple(freeze(part) for part in key)
+  return key
+
+
+def tag_tokens(cache, tags):
+  tokens = []
+  for tag in tags:
+    token = cache.get(('tag', tag))
+    if token is None:
+      token = uuid.uuid4().hex
+      cache.set(('tag', tag), token)
+    tokens.append(token)
+  return tuple(tokens)
+
+
+def fragment(site, key, ttl, tags, render):
+  """The HTML of a cached block, calling render() to make it on a miss."""
+  cache = get_fragment_cache()
+  if cache is None:
+    return render()
+  tags = freeze(tags or ())
+  cache_key = ('fragment', site, freeze(key), tag_tokens(cache, tags))
+  html = cache.get(cache_key)
+  if html is None:
+    html = Markup(render())
+    cache.set(cache_key, html, ttl)
+  return html
+
+
+def invalidate(*tags):
+  """Drop every fragment cached under any of these tags."""
+  cache = get_fragment_cache()
+  if cache is not None:
+    for tag in tags:
+      cache.delete(('tag', tag))
+
+
+class FragmentCacheExtension(Extension):
+  """The {% cache key[, ttl[, tags]] %} ... {% endcache %} tag."""
+
+  tags = {'cache'}
+
+  def parse(self, parser):
+    lineno = next(parser.stream).lineno
+    args = [parser.parse_expression()]
+    while parser.stream.skip_if('comma'):
+      args.append(parser.parse_expression())
+    if len(args) > 3:
+      parser.fail("cache takes a key, a ttl and tags", lineno)
+    args.extend([nodes.Const(None)] * (3 - len(args)))
+    site = nodes.Const('%s:%d' % (parser.name, lineno))
+    body = parser.parse_statements(['name:endcache'], drop_needle=True)
+    return nodes.CallBlock(self.call_method('_cache', [site] + args), [], [], body).set_lineno(lineno)
+
+  def _cache(self, site, key, ttl, tags, caller):
+    return fragment(site, key, ttl, tags, caller)
+
+
+def init_app(app):
+  app.jinja_env.add_extension(FragmentCacheExtension)
@@ -0,0 +1,81 @@
+"""
+Collision-free primary keys for the VARCHAR id columns.
+
+Each key space reserves a block of numbers from its own Postgres sequence
+(one nextval() per BLOCK_SIZE ids) and hands them out from memory, so
+allocating an id normally costs no database round trip and never needs a
+"does this exist?" SELECT. Sequences never return the same value twice, so
+ids stay unique across threads, workers and restarts; an unused tail of a
+block is simply skipped.
+
+Ids are a lowercase letter naming the key space followed by the number in
+lowercase base 36, e.g. 'u00002s' or 'p00000017x'. The old random
+generator only produced upper-case letters and digits, so new ids can
+never collide with rows it created.
+
+The sequences step by BLOCK_SIZE (migration 0011), and nextval() is the
+first number of the block, so a block always covers the same range. Do
+not change BLOCK_SIZE without a migration that changes INCREMENT BY.
+"""
+import threading
+
+from db import get_engine
+
+
+alphabet = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+# The sequences' INCREMENT BY.
+BLOCK_SIZE = 1000
+
+
+def encode(number, width):
+  digits = ''
+  rest = number
+  while rest:
+    rest, rem = divmod(rest, len(alphabet))
+    digits = alphabet[rem] + digits
+  if len(digits) > width:
+    raise OverflowError("id %d does not fit in %d characters" % (number, width))
+  return digits.rjust(width, '0')
+
+
+def reserve_block(sequence):
+  """Claim the next block from a Postgres sequence; returns its first number."""
+  with get_engine().connect() as conn:
+    return conn.execute("SELECT nextval(%s)", sequence).scalar()
+
+
+class IdAllocator(object):
+  """
+  Thread-safe allocator for one key space.
+
+  reserve is called with the sequence name whenever the current block is
+  used up and must return the first number of a block of block_size
+  numbers that no call has returned before.
+  """
+
+  def __init__(self, prefix, width, sequence, block_size=BLOCK_SIZE, reserve=reserve_block):
+    self.prefix = prefix
+    self.width = width
+    self.sequence = sequence
+    self.block_size = block_size
+    self.reserve = reserve
+    self.lock = threading.Lock()
+    self.next = 0
+    self.end = 0
+
+  def next_id(self):
+    with self.lock:
+      if self.next >= self.end:
+        self.next = self.reserve(self.sequence)
+        self.end = self.next + self.block_size
+      number = self.next
+      self.next += 1
+    return self.prefix + encode(number, self.width - len(self.prefix))
+
+
+user_ids = IdAllocator('u', 7, 'user_id_blocks')
+post_ids = IdAllocator('p', 10, 'post_id_blocks')
+order_ids = IdAllocator('o', 10, 'order_id_blocks')
+review_ids = IdAllocator('r', 7, 'review_id_blocks')
+chat_ids = IdAllocator('c', 10, 'chat_id_blocks')
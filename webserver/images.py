@@ -0,0 +1,162 @@
+"""
+Resized product images.
+
+Originals live in static/images/<product_number> (full-size PNGs). Pages
+never send those: each product image is served as one of the VARIANTS
+below, a WebP scaled to that width (never enlarged), and templates list
+all of them in srcset so the browser downloads the smallest that fits.
+
+Derivatives are made on first request (or ahead of time with
+`manage.py build-images`) and kept in a content-addressed cache under
+IMAGE_CACHE_DIR: the file name is a hash of the original's bytes and the
+variant's settings, so replacing an original or changing a variant never
+serves a stale file. Image URLs carry that name as ?v=, so browsers may
+keep them for good (see static_files.py). The cache is bounded by
+IMAGE_CACHE_MAX_BYTES; the least recently served files are removed first.
+
+The names can be worked out from the originals in the repository, so the
+cache directory must be private to the app's user, or anyone who could
+write to it would have their bytes served as immutable images. It
+defaults to images/ in the instance folder, and startup fails if the
+directory is not owned by this user with mode 0700.
+"""
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+from flask import current_app, url_for
+
+from static_files import file_digest
+from templating import private_dir
+
+
+# name -> (width, WebP quality)
+VARIANTS = {
+  'thumb': (160, 70),
+  'listing': (400, 75),
+  'detail': (900, 80),
+}
+
+originals_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'images')
+
+_lock = threading.Lock()
+_cache_bytes = None
+
+
+def original_path(product_number):
+  """The original image of a product, or None if there is none."""
+  path = os.path.join(originals_dir, os.path.basename(product_number))
+  return path if os.path.isfile(path) else None
+
+
+def derivative_name(source_digest, variant):
+  width, quality = VARIANTS[variant]
+  return hashlib.sha1(('%s:%d:%d:webp' % (source_digest, width, quality)).encode()).hexdigest()
+
+
+def derivative_path(cache_dir, name):
+  return os.path.join(cache_dir, name[:2], name + '.webp')
+
+
+def version(product_number, variant):
+  """The ?v= of a derivative's URL: its cache name, or None without an original."""
+  source = original_path(product_number)
+  return derivative_name(file_digest(source), variant)[:12] if source else None
+
+
+def render(path, variant):
+  """The WebP bytes of one variant of the image at path."""
+  # Imported here so that workers that never resize pay nothing at import.
+  from PIL import Image
+
+  width, quality = VARIANTS[variant]
+  with Image.open(path) as image:
+    image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    if image.width > width:
+      image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, 'WEBP', quality=quality, method=6)
+  return out.getvalue()
+
+
+def cache_size(cache_dir):
+  total = 0
+  for root, dirs, files in os.walk(cache_dir):
+    for name in files:
+      total += os.path.getsize(os.path.join(root, name))
+  return total
+
+
+def evict(cache_dir, max_bytes):
+  """Remove the least recently served derivatives until the cache fits."""
+  global _cache_bytes
+  entries = []
+  for root, dirs, files in os.walk(cache_dir):
+    for name in files:
+      path = os.path.join(root, name)
+      stat = os.stat(path)
+      entries.append((stat.st_atime, stat.st_size, path))
+  entries.sort()
+  total = sum(size for _, size, _ in entries)
+  for _, size, path in entries:
+    if total <= max_bytes:
+      break
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+    total -= size
+  _cache_bytes = total
+
+
+def derivative(product_number, variant):
+  """
+  Path of the cached derivative, making it first if needed; None if the
+  product has no image.
+  """
+  global _cache_bytes
+  source = original_path(product_number)
+  if source is None:
+    return None
+  config = current_app.config
+  cache_dir = config['IMAGE_CACHE_DIR']
+  path = derivative_path(cache_dir, derivative_name(file_digest(source), variant))
+  if os.path.exists(path):
+    os.utime(path)
+    return path
+
+  data = render(source, variant)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  # Write then rename, so a concurrent request never reads half a file.
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+  with os.fdopen(fd, 'wb') as f:
+    f.write(data)
+  os.replace(tmp, path)
+
+  with _lock:
+    if _cache_bytes is None:
+      _cache_bytes = cache_size(cache_dir)
+    else:
+      _cache_bytes += len(data)
+    if _cache_bytes > config['IMAGE_CACHE_MAX_BYTES']:
+      evict(cache_dir, config['IMAGE_CACHE_MAX_BYTES'] * 9 // 10)
+  return path
+
+
+def image_url(product_number, variant='listing'):
+  return url_for('main.product_image', product_number=product_number, variant=variant,
+                 v=version(product_number, variant))
+
+
+def image_srcset(product_number):
+  return ", ".join("%s %dw" % (image_url(product_number, name), width)
+                   for name, (width, quality) in sorted(VARIANTS.items(), key=lambda v: v[1][0]))
+
+
+def init_app(app):
+  if not app.config['IMAGE_CACHE_DIR']:
+    app.config['IMAGE_CACHE_DIR'] = os.path.join(app.instance_path, 'images')
+  private_dir(app.config['IMAGE_CACHE_DIR'])
+  app.context_processor(lambda: {'image_url': image_url, 'image_srcset': image_srcset})
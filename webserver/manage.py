@@ -0,0 +1,148 @@
+"""
+One-shot maintenance commands that must not run on every worker start.
+
+    python3 manage.py migrate          apply pending migrations/*.sql
+    python3 manage.py migrate --list   show which migrations have run
+    python3 manage.py check-timelines  compare materialized feeds with the pull query
+    python3 manage.py rebuild-chat-rooms USER_ID...
+                                       recompute inbox summaries from chat
+    python3 manage.py recompute-review-summaries [PRODUCT_NUMBER...]
+                                       repair review counts from review_posts
+    python3 manage.py build-images     make every resized product image ahead of time
+    python3 manage.py build-assets     build the minified CSS/JS bundles
+    python3 manage.py compile-templates
+                                       fill the template bytecode cache
+"""
+import os
+
+import click
+
+import assets
+import images
+import reviews
+import templating
+import timeline
+from chats import rebuild_rooms
+from db import get_engine
+from server import app
+
+
+migrations_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def migration_files():
+  return sorted(f for f in os.listdir(migrations_dir) if f.endswith('.sql'))
+
+
+@click.group()
+def cli():
+  pass
+
+
+@cli.command()
+@click.option('--list', 'list_only', is_flag=True, help='Only show migration status.')
+def migrate(list_only):
+  """
+  Apply every migration in migrations/ that has not been applied yet. Each
+  file runs in its own transaction and is recorded in schema_migrations.
+  """
+  with app.app_context():
+    engine = get_engine()
+    engine.execute("CREATE TABLE IF NOT EXISTS schema_migrations (name text PRIMARY KEY, applied_at timestamp DEFAULT now())")
+    applied = set(r['name'] for r in engine.execute("SELECT name FROM schema_migrations"))
+
+    for name in migration_files():
+      if list_only:
+        print("%s %s" % ('x' if name in applied else ' ', name))
+        continue
+      if name in applied:
+        continue
+      with open(os.path.join(migrations_dir, name)) as f:
+        sql = f.read()
+      with engine.begin() as conn:
+        conn.exec_driver_sql(sql)
+        conn.execute("INSERT INTO schema_migrations(name) VALUES (%s)", name)
+      print("applied %s" % name)
+
+
+@cli.command('check-timelines')
+@click.option('--repair', is_flag=True, help='Rebuild timelines that have drifted.')
+def check_timelines(repair):
+  """
+  Consistency check for FEED_MODE=push. Only meaningful for the shared
+  sqlite store; memory timelines live inside each worker process.
+  """
+  with app.app_context():
+    store = timeline.get_store()
+    if store is None:
+      print("FEED_MODE is not 'push'; nothing to check")
+      return
+    drifted = 0
+    with get_engine().connect() as conn:
+      for user_id in store.user_ids():
+        missing, extra = timeline.check(conn, store, user_id)
+        if not missing and not extra:
+          continue
+        drifted += 1
+        print("%s: %d missing, %d extra" % (user_id, len(missing), len(extra)))
+        if repair:
+          store.drop(user_id)
+    print("%d timelines drifted%s" % (drifted, ' (dropped, rebuilt on next read)' if repair and drifted else ''))
+    if drifted and not repair:
+      raise SystemExit(1)
+
+
+@cli.command('rebuild-chat-rooms')
+@click.argument('user_ids', nargs=-1, required=True)
+def rebuild_chat_rooms(user_ids):
+  """Recompute the chat_rooms summaries of the given users' sessions."""
+  with app.app_context():
+    with get_engine().connect() as conn:
+      for user_id in user_ids:
+        rebuild_rooms(conn, user_id)
+        print("rebuilt rooms of %s" % user_id)
+
+
+@cli.command('recompute-review-summaries')
+@click.argument('product_numbers', nargs=-1)
+def recompute_review_summaries(product_numbers):
+  """Rewrite review_summaries from review_posts (all products by default)."""
+  with app.app_context():
+    with get_engine().connect() as conn:
+      fixed = reviews.recompute(conn, product_numbers)
+    print("%d review summaries corrected" % fixed)
+
+
+@cli.command('build-images')
+def build_images():
+  """Fill the image cache with every variant of every product image."""
+  with app.test_request_context():
+    made = 0
+    for name in sorted(os.listdir(images.originals_dir)):
+      # Originals are named by product_number; skip icons like up.png.
+      if '.' in name:
+        continue
+      for variant in images.VARIANTS:
+        images.derivative(name, variant)
+        made += 1
+    print("%d derivatives in %s" % (made, app.config['IMAGE_CACHE_DIR']))
+
+
+@cli.command('build-assets')
+def build_assets():
+  """Compile every CSS/JS bundle into static/gen and record its version."""
+  with app.test_request_context():
+    for url in assets.build(app):
+      print(url)
+
+
+@cli.command('compile-templates')
+def compile_templates():
+  """Compile every template into TEMPLATE_CACHE_DIR."""
+  names = templating.precompile(app)
+  cache = app.jinja_env.bytecode_cache
+  print("%d templates in %s" % (len(names), cache.directory if cache else '(no bytecode cache)'))
+
+
+if __name__ == "__main__":
+  cli()
@@ -0,0 +1,7 @@
+-- The example table from the course skeleton. This used to be created (and
+-- re-seeded) every time server.py was imported; it now runs exactly once.
+CREATE TABLE IF NOT EXISTS test (
+  id serial,
+  name text
+);
+INSERT INTO test(name) VALUES ('grace hopper'), ('alan turing'), ('ada lovelace');
@@ -0,0 +1,8 @@
+-- Block sequences for ids.IdAllocator: each nextval() reserves a block of
+-- ids for one worker. Migration 0011 makes them step by ids.BLOCK_SIZE,
+-- with nextval() the first id of the block.
+CREATE SEQUENCE IF NOT EXISTS user_id_blocks;
+CREATE SEQUENCE IF NOT EXISTS post_id_blocks;
+CREATE SEQUENCE IF NOT EXISTS order_id_blocks;
+CREATE SEQUENCE IF NOT EXISTS review_id_blocks;
+CREATE SEQUENCE IF NOT EXISTS chat_id_blocks;
@@ -0,0 +1,2 @@
+-- Serves each author's posts newest-first for the /home feed keyset scan.
+CREATE INDEX IF NOT EXISTS posts_user_date_idx ON posts (user_id, date_time DESC, post_id DESC);
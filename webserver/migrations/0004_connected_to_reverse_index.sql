@@ -0,0 +1,3 @@
+-- Followers of a user (connected_to's primary key only covers
+-- user_id -> connection); used to fan posts out to their timelines.
+CREATE INDEX IF NOT EXISTS connected_to_connection_idx ON connected_to (connection);
@@ -0,0 +1,24 @@
+-- Message history of one room in order, and the sessions a user is in.
+CREATE INDEX IF NOT EXISTS chat_session_message_idx ON chat (session_id, message_id);
+CREATE INDEX IF NOT EXISTS chat_sender_idx ON chat (sender);
+CREATE INDEX IF NOT EXISTS chat_recipient_idx ON chat (recipient);
+
+-- One summary row per chat session: its two participants and last message.
+-- Maintained by /newchat and /send_message; read by the /chat inbox.
+CREATE TABLE IF NOT EXISTS chat_rooms (
+  session_id      VARCHAR(10) PRIMARY KEY,
+  user_a          VARCHAR(10) NOT NULL,
+  user_b          VARCHAR(10) NOT NULL,
+  last_message_id INTEGER NOT NULL DEFAULT 0,
+  last_content    VARCHAR(1000),
+  last_sender     VARCHAR(10),
+  last_date_time  TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS chat_rooms_user_a_idx ON chat_rooms (user_a);
+CREATE INDEX IF NOT EXISTS chat_rooms_user_b_idx ON chat_rooms (user_b);
+
+INSERT INTO chat_rooms (session_id, user_a, user_b, last_message_id, last_content, last_sender, last_date_time)
+SELECT DISTINCT ON (session_id) session_id, sender, recipient, message_id, content, sender, date_time
+FROM chat
+ORDER BY session_id, message_id DESC
+ON CONFLICT (session_id) DO NOTHING;
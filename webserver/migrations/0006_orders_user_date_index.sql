@@ -0,0 +1,2 @@
+-- Serves a user's order history newest-first for the /cart keyset pages.
+CREATE INDEX IF NOT EXISTS orders_user_date_idx ON orders (user_id, order_date DESC, order_number DESC);
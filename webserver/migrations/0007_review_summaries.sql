@@ -0,0 +1,16 @@
+-- Reviews of one product, for the item page and the summary recompute.
+CREATE INDEX IF NOT EXISTS review_posts_product_idx ON review_posts (reviewed_product);
+
+-- Per-product review counts: thumbs up and total. Maintained by /addreview
+-- and /removereview; read by item pages and product listings.
+CREATE TABLE IF NOT EXISTS review_summaries (
+  product_number VARCHAR(10) PRIMARY KEY REFERENCES products (product_number),
+  up_count       INTEGER NOT NULL DEFAULT 0,
+  total          INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO review_summaries (product_number, up_count, total)
+SELECT reviewed_product, COUNT(*) FILTER (WHERE review_type = 'thumbs up'), COUNT(*)
+FROM review_posts
+GROUP BY reviewed_product
+ON CONFLICT (product_number) DO NOTHING;
@@ -0,0 +1,8 @@
+-- When each review was posted, so item pages can list reviews newest first.
+-- Existing reviews get the migration time and fall back to review_id order.
+ALTER TABLE review_posts ADD COLUMN IF NOT EXISTS posted_at TIMESTAMP NOT NULL DEFAULT now();
+
+-- Serves one product's reviews newest-first for the item page keyset scan;
+-- it also covers every lookup the plain product index did.
+CREATE INDEX IF NOT EXISTS review_posts_product_posted_idx ON review_posts (reviewed_product, posted_at DESC, review_id DESC);
+DROP INDEX IF EXISTS review_posts_product_idx;
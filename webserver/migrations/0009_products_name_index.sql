@@ -0,0 +1,2 @@
+-- Resolves the old /item?type=<name>&color=<color> URLs to a product_number.
+CREATE INDEX IF NOT EXISTS products_name_color_idx ON products (name, color);
@@ -0,0 +1,11 @@
+-- When a product was listed, for the "newest" sort of category and brand pages.
+ALTER TABLE products ADD COLUMN IF NOT EXISTS listed_at TIMESTAMP NOT NULL DEFAULT now();
+
+-- Serve category (item_type) and brand (sold_by) listings in each sort
+-- order for the keyset scan; see catalog.SORTS for the matching expressions.
+CREATE INDEX IF NOT EXISTS products_type_name_idx ON products (item_type, name, product_number);
+CREATE INDEX IF NOT EXISTS products_type_price_idx ON products (item_type, COALESCE(price, 0), product_number);
+CREATE INDEX IF NOT EXISTS products_type_listed_idx ON products (item_type, listed_at DESC, product_number DESC);
+CREATE INDEX IF NOT EXISTS products_seller_name_idx ON products (sold_by, name, product_number);
+CREATE INDEX IF NOT EXISTS products_seller_price_idx ON products (sold_by, COALESCE(price, 0), product_number);
+CREATE INDEX IF NOT EXISTS products_seller_listed_idx ON products (sold_by, listed_at DESC, product_number DESC);
@@ -0,0 +1,16 @@
+-- Each nextval() now returns the first id of a block of ids.BLOCK_SIZE
+-- (1000) ids, instead of a block number that the allocator multiplied by
+-- a size read from the environment: the range a value stands for can no
+-- longer change between deploys. Restart every sequence past the ids
+-- already handed out as block * 1000 (the old default ID_BLOCK_SIZE; a
+-- deployment that ran with a larger one must raise these further).
+ALTER SEQUENCE user_id_blocks INCREMENT BY 1000;
+ALTER SEQUENCE post_id_blocks INCREMENT BY 1000;
+ALTER SEQUENCE order_id_blocks INCREMENT BY 1000;
+ALTER SEQUENCE review_id_blocks INCREMENT BY 1000;
+ALTER SEQUENCE chat_id_blocks INCREMENT BY 1000;
+SELECT setval('user_id_blocks', (last_value + 1) * 1000, false) FROM user_id_blocks;
+SELECT setval('post_id_blocks', (last_value + 1) * 1000, false) FROM post_id_blocks;
+SELECT setval('order_id_blocks', (last_value + 1) * 1000, false) FROM order_id_blocks;
+SELECT setval('review_id_blocks', (last_value + 1) * 1000, false) FROM review_id_blocks;
+SELECT setval('chat_id_blocks', (last_value + 1) * 1000, false) FROM chat_id_blocks;
@@ -0,0 +1,275 @@
+"""
+Cart, checkout and order history queries.
+
+/cart, /checkout and /setaddress read through the loaders here, each a
+single query: the cart lines joined to products, the user's addresses, and
+one page of order history with the items of every order on it.
+
+With CART_CACHE on, cart_lines() serves the cart from a per-user cache
+instead. Every write goes to has_in_cart first and then drops the user's
+entry (invalidate_cart), so the next read refills it from the database and
+a cached cart is never newer than the table; CART_CACHE_TTL bounds how
+stale product fields in it (name, price, stock) can get. Invalidation only
+reaches the store it is made in, so the cache is off by default and
+init_app() refuses 'memory' when WEB_CONCURRENCY > 1: another worker would show
+the cart as it was before the write, and checkout orders what is really
+in has_in_cart.
+
+Checkout is one transaction with a fixed number of statements however big
+the cart is:
+
+  1. lock the user's cart rows and the products in it, in product_number
+     order, and check every line against stock;
+  2. decrement stock for the locked lines in one UPDATE;
+  3. insert the order and its lines into contains_item in one INSERT;
+  4. take those lines out of the cart.
+
+Steps 2-4 use the lines read in step 1, not the cart table again: a line
+added by a concurrent add_to_cart was not locked or checked, so it is
+left in the cart rather than ordered past its stock.
+
+Locking in product_number order means concurrent checkouts of the same
+products queue on the row locks instead of deadlocking, and they hold them
+only for these few statements. An order that would oversell any line is
+refused as a whole and nothing is written. A second submit of the same
+cart waits on the cart row locks and then finds the cart empty.
+"""
+import threading
+
+from flask import current_app
+
+from cache import make_cache
+from db import decode_cursor, encode_cursor, transaction
+
+
+class OrderError(Exception):
+  """Checkout was refused; the transaction was rolled back."""
+
+
+def place_order(conn, order_id, user_id, date, address):
+  """
+  Turn user_id's cart into order order_id, shipped to address (a mapping
+  with street_1, street_2 and zip; with city and state too it is added to
+  addresses if it is new). Raises OrderError if the cart is empty or a
+  product does not have enough stock.
+  """
+  with transaction(conn):
+    cursor = conn.execute("""
+      SELECT P.product_number, P.name, P.stock, C.quantity
+      FROM has_in_cart C JOIN products P ON P.product_number = C.product_number
+      WHERE C.user_id = (%s)
+      ORDER BY P.product_number
+      FOR UPDATE""", user_id)
+    lines = cursor.fetchall()
+    cursor.close()
+    if not lines:
+      raise OrderError("Your cart is empty.")
+
+    # A NULL stock is not tracked and never runs out.
+    short = [line for line in lines if line['stock'] is not None and line['stock'] < line['quantity']]
+    if short:
+      raise OrderError("Not enough stock for " + ", ".join(
+        "%s (%d left)" % (line['name'], line['stock']) for line in short))
+
+    if 'city' in address:
+      conn.execute("INSERT INTO addresses VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                   address['street_1'], address['street_2'], address['city'], address['state'], address['zip'])
+
+    # Steps 2-4 on the locked lines only (see the module docstring).
+    values = ", ".join(["(%s::varchar, %s::integer)"] * len(lines))
+    locked = [value for line in lines for value in (line['product_number'], line['quantity'])]
+    conn.execute("""
+      UPDATE products P SET stock = P.stock - V.quantity
+      FROM (VALUES {values}) V (product_number, quantity)
+      WHERE P.product_number = V.product_number AND P.stock IS NOT NULL""".format(values=values), *locked)
+    conn.execute("INSERT INTO orders VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                 order_id, date, "Processing", user_id, address['street_1'], address['street_2'], address['zip'])
+    conn.execute("INSERT INTO contains_item (order_number, product_number, quantity) VALUES " +
+                 ", ".join(["(%s, %s, %s)"] * len(lines)),
+                 *[value for line in lines for value in (order_id, line['product_number'], line['quantity'])])
+    conn.execute("""
+      DELETE FROM has_in_cart C USING (VALUES {values}) V (product_number, quantity)
+      WHERE C.user_id = (%s) AND C.product_number = V.product_number""".format(values=values), *locked, user_id)
+
+
+def add_to_cart(conn, user_id, lines):
+  """
+  Add (product_number, quantity) lines to user_id's cart in one upsert.
+  A line is refused if its quantity is not a positive integer, the product
+  does not exist, or the cart would then hold more than the product's
+  stock. Returns [(product_number, name, added)] for every product given.
+  """
+  wanted = {}
+  refused = []
+  for product_number, quantity in lines:
+    try:
+      quantity = int(quantity)
+    except (TypeError, ValueError):
+      quantity = 0
+    if quantity > 0:
+      wanted[product_number] = wanted.get(product_number, 0) + quantity
+    else:
+      refused.append((product_number, None, False))
+  if not wanted:
+    return refused
+
+  values = ", ".join(["(%s::varchar, %s::integer)"] * len(wanted))
+  params = [value for line in wanted.items() for value in line]
+  with transaction(conn):
+    cursor = conn.execute("""
+      WITH V (product_number, quantity) AS (VALUES {values}),
+      added AS (
+        INSERT INTO has_in_cart AS C (user_id, product_number, quantity)
+        SELECT %s, V.product_number, V.quantity
+        FROM V JOIN products P ON P.product_number = V.product_number
+        WHERE P.stock IS NULL OR V.quantity <= P.stock
+        ON CONFLICT (user_id, product_number) DO UPDATE SET quantity = C.quantity + EXCLUDED.quantity
+        WHERE C.quantity + EXCLUDED.quantity <= COALESCE(
+          (SELECT stock FROM products WHERE product_number = EXCLUDED.product_number), C.quantity + EXCLUDED.quantity)
+        RETURNING C.product_number
+      )
+      SELECT V.product_number, P.name, A.product_number IS NOT NULL AS added
+      FROM V LEFT JOIN products P ON P.product_number = V.product_number
+        LEFT JOIN added A ON A.product_number = V.product_number""".format(values=values), *params, user_id)
+    result = [tuple(row) for row in cursor]
+    cursor.close()
+  return result + refused
+
+
+def remove_from_cart(conn, user_id, product_number, quantity=None):
+  """
+  Take quantity units of a product out of the cart in one statement, or
+  the whole line when quantity is None or at least what the cart holds.
+  Raises ValueError unless quantity is None or a positive integer.
+  """
+  if quantity is not None and (not isinstance(quantity, int) or quantity < 1):
+    raise ValueError("quantity to remove must be a positive integer, not %r" % (quantity,))
+  if quantity is None:
+    conn.execute("DELETE FROM has_in_cart WHERE user_id = (%s) AND product_number = (%s)", user_id, product_number)
+    return
+  # The DELETE and the UPDATE see the same snapshot and match exclusive rows.
+  with transaction(conn):
+    conn.execute("""
+      WITH removed AS (
+        DELETE FROM has_in_cart
+        WHERE user_id = (%s) AND product_number = (%s) AND quantity <= (%s)
+      )
+      UPDATE has_in_cart SET quantity = quantity - (%s)
+      WHERE user_id = (%s) AND product_number = (%s) AND quantity > (%s)""",
+      user_id, product_number, quantity, quantity, user_id, product_number, quantity)
+
+
+def load_cart(conn, user_id):
+  """The user's cart lines joined to their products, by product name."""
+  cursor = conn.execute("""
+    SELECT C.product_number, C.quantity, P.name, P.price, P.stock
+    FROM has_in_cart C JOIN products P ON P.product_number = C.product_number
+    WHERE C.user_id = (%s)
+    ORDER BY P.name, C.product_number""", user_id)
+  lines = cursor.fetchall()
+  cursor.close()
+  return lines
+
+
+def load_addresses(conn, user_id):
+  """Every address the user lives at (lives_at joined to addresses)."""
+  cursor = conn.execute("""
+    SELECT A.street_1, A.street_2, A.city, A.state, A.zip
+    FROM lives_at L JOIN addresses A
+      ON A.street_1 = L.street_1 AND A.zip = L.zip AND A.street_2 IS NOT DISTINCT FROM L.street_2
+    WHERE L.user_id = (%s)
+    ORDER BY A.street_1, A.zip""", user_id)
+  addresses = cursor.fetchall()
+  cursor.close()
+  return addresses
+
+
+_cart_cache = None
+_cart_cache_lock = threading.Lock()
+
+
+def get_cart_cache():
+  """This process's cart cache, or None when CART_CACHE is 'off'."""
+  global _cart_cache
+  config = current_app.config
+  if config['CART_CACHE'] == 'off':
+    return None
+  if _cart_cache is None:
+    with _cart_cache_lock:
+      if _cart_cache is None:
+        _cart_cache = make_cache('carts', config['CART_CACHE'], config['CART_CACHE_SIZE'], config['CART_CACHE_TTL'])
+  return _cart_cache
+
+
+def init_app(app):
+  """Check the cart cache setting, so a bad deploy fails to boot instead of failing every cart page."""
+  config = app.config
+  if config['CART_CACHE'] == 'memory' and config['WEB_CONCURRENCY'] > 1:
+    raise ValueError("CART_CACHE='memory' is per process; use a shared store with WEB_CONCURRENCY > 1")
+
+
+def cart_lines(conn, user_id):
+  """load_cart() as dicts, through the cart cache when it is on."""
+  cache = get_cart_cache()
+  if cache is None:
+    return [dict(line) for line in load_cart(conn, user_id)]
+  lines = cache.get(user_id)
+  if lines is None:
+    lines = [dict(line) for line in load_cart(conn, user_id)]
+    cache.set(user_id, lines)
+  return lines
+
+
+def invalidate_cart(user_id):
+  """Call after any write to user_id's has_in_cart rows."""
+  cache = get_cart_cache()
+  if cache is not None:
+    cache.delete(user_id)
+
+
+def load_orders(conn, user_id, before=None, limit=10):
+  """
+  One page of user_id's orders, newest first, starting after the cursor
+  `before`, each with its items. Returns (orders, next_cursor);
+  next_cursor is None on the last page.
+  """
+  params = [user_id]
+  keyset = ''
+  position = decode_cursor(before)
+  if position:
+    keyset = "AND (O.order_date, O.order_number) < (%s, %s)"
+    params.extend(position)
+  params.append(limit + 1)
+
+  # The page of orders and all of their items in one round trip.
+  cursor = conn.execute("""
+    SELECT O.order_number, O.order_date, O.status, O.street_1, O.street_2, O.zip,
+           I.product_number, I.quantity, P.name
+    FROM (SELECT * FROM orders O
+          WHERE O.user_id = (%s) {keyset}
+          ORDER BY O.order_date DESC, O.order_number DESC
+          LIMIT %s) O
+      LEFT JOIN contains_item I ON I.order_number = O.order_number
+      LEFT JOIN products P ON P.product_number = I.product_number
+    ORDER BY O.order_date DESC, O.order_number DESC, P.name""".format(keyset=keyset), *params)
+  orders = []
+  for row in cursor:
+    if not orders or orders[-1]['order_number'] != row['order_number']:
+      orders.append({
+        'order_number': row['order_number'],
+        'order_date': row['order_date'],
+        'status': row['status'],
+        'street_1': row['street_1'],
+        'street_2': row['street_2'],
+        'zip': row['zip'],
+        'items': [],
+      })
+    if row['product_number'] is not None:
+      orders[-1]['items'].append({'name': row['name'], 'quantity': row['quantity']})
+  cursor.close()
+
+  next_cursor = None
+  if len(orders) > limit:
+    orders = orders[:limit]
+    next_cursor = encode_cursor(orders[-1]['order_date'], orders[-1]['order_number'])
+  return orders, next_cursor
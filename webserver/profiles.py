@@ -0,0 +1,59 @@
+"""
+Profile page queries.
+
+The page is built from a fixed number of queries however many connections
+the user has: the account with its consumer preferences, the current
+address, and one page of the follow list joined to users.
+"""
+
+
+def load_account(conn, user_id):
+  """users joined to consumers; None if the user does not exist."""
+  cursor = conn.execute("""
+    SELECT U.user_id, U.username, U.email, U.name, C.size_pref, C.date_of_birth, C.user_id AS consumer_id
+    FROM users U LEFT JOIN consumers C ON C.user_id = U.user_id
+    WHERE U.user_id = (%s)""", user_id)
+  account = cursor.fetchone()
+  cursor.close()
+  return account
+
+
+def load_address(conn, user_id):
+  """The address the user lives at (lives_at joined to addresses), or None."""
+  cursor = conn.execute("""
+    SELECT A.*
+    FROM lives_at L JOIN addresses A
+      ON A.street_1 = L.street_1 AND A.zip = L.zip AND A.street_2 IS NOT DISTINCT FROM L.street_2
+    WHERE L.user_id = (%s)
+    LIMIT 1""", user_id)
+  address = cursor.fetchone()
+  cursor.close()
+  return address
+
+
+def load_friends(conn, user_id, after=None, limit=50):
+  """
+  One page of the users user_id follows, ordered by username, starting after
+  the username `after`. Returns (friends, next_after); next_after is None on
+  the last page.
+  """
+  params = [user_id]
+  keyset = ''
+  if after:
+    keyset = "AND U.username > (%s)"
+    params.append(after)
+  params.append(limit + 1)
+  cursor = conn.execute("""
+    SELECT U.user_id, U.username
+    FROM connected_to C JOIN users U ON U.user_id = C.connection
+    WHERE C.user_id = (%s) {keyset}
+    ORDER BY U.username
+    LIMIT %s""".format(keyset=keyset), *params)
+  friends = cursor.fetchall()
+  cursor.close()
+
+  next_after = None
+  if len(friends) > limit:
+    friends = friends[:limit]
+    next_after = friends[-1]['username']
+  return friends, next_after
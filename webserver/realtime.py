@@ -0,0 +1,168 @@
+"""
+Real-time chat delivery over Socket.IO.
+
+Sending a message is one INSERT (chats.send) plus one broker.publish().
+The broker hands the message to every subscriber; the subscriber installed
+here emits it to the Socket.IO room of the chat session and to both
+participants' personal rooms (so their inboxes update), which is how it
+reaches open browser tabs without a page reload.
+
+The broker is pluggable (CHAT_BROKER): 'local' is an in-memory broker that
+delivers inside this process, or give 'module:Class' for another
+implementation with the same publish/subscribe methods. To fan out across
+several workers set SOCKETIO_MESSAGE_QUEUE (e.g. a redis:// URL); emits
+then go through that queue and reach clients connected to any worker.
+
+The async mode is explicit (SOCKETIO_ASYNC_MODE) rather than whatever
+Flask-SocketIO finds installed: eventlet is in requirements.txt, but
+nothing monkey-patches it, and unpatched psycopg2 calls would block its
+single event loop. With the default 'threading' mode serve the app from
+one threaded worker (Socket.IO needs sticky sessions to use more, plus
+SOCKETIO_MESSAGE_QUEUE):
+
+    gunicorn --workers 1 --threads 100 server:app
+
+WebSocket transport in that mode needs simple-websocket; without it
+clients fall back to long-polling. 'eventlet' needs
+`gunicorn --worker-class eventlet --workers 1 server:app` with eventlet
+and psycopg2 (psycogreen) patched before anything else is imported.
+
+Clients join a chat session with the 'join' event. RoomPresence tracks who
+has each room open, and every change is broadcast to the room as a
+'presence' event.
+"""
+import importlib
+import threading
+from collections import defaultdict
+
+from flask import current_app, request, session
+from flask_socketio import SocketIO, emit, join_room, leave_room
+
+from chats import message_dict
+from db import get_conn
+
+
+socketio = SocketIO()
+
+
+class LocalBroker(object):
+  """In-memory publish/subscribe within one process."""
+
+  def __init__(self):
+    self.subscribers = []
+
+  def subscribe(self, callback):
+    self.subscribers.append(callback)
+
+  def publish(self, message):
+    for callback in self.subscribers:
+      callback(message)
+
+
+class RoomPresence(object):
+  """Which users have which chat rooms open, keyed by Socket.IO session."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.sids = {}                   # sid -> (user_id, room_id)
+    self.rooms = defaultdict(dict)   # room_id -> {user_id: open connections}
+
+  def join(self, sid, user_id, room_id):
+    with self.lock:
+      self._leave(sid)
+      self.sids[sid] = (user_id, room_id)
+      users = self.rooms[room_id]
+      users[user_id] = users.get(user_id, 0) + 1
+
+  def leave(self, sid):
+    """Forget sid; returns the room it was in, or None."""
+    with self.lock:
+      return self._leave(sid)
+
+  def _leave(self, sid):
+    entry = self.sids.pop(sid, None)
+    if entry is None:
+      return None
+    user_id, room_id = entry
+    users = self.rooms[room_id]
+    users[user_id] -= 1
+    if not users[user_id]:
+      del users[user_id]
+    if not users:
+      del self.rooms[room_id]
+    return room_id
+
+  def present(self, room_id):
+    with self.lock:
+      return sorted(self.rooms.get(room_id, ()))
+
+
+presence = RoomPresence()
+
+
+def make_broker(name):
+  if name == 'local':
+    return LocalBroker()
+  module, cls = name.split(':')
+  return getattr(importlib.import_module(module), cls)()
+
+
+def user_room(user_id):
+  return 'user:%s' % user_id
+
+
+def deliver(message):
+  socketio.emit('message', message, to=message['room_id'])
+  for user_id in (message['sender'], message['recipient']):
+    socketio.emit('inbox', message, to=user_room(user_id))
+
+
+def publish(row):
+  """Push a stored chat row (as returned by chats.send) to its room."""
+  current_app.extensions['chat_broker'].publish(dict(message_dict(row), recipient=row['recipient']))
+
+
+def init_app(app):
+  socketio.init_app(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+                    message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'] or None)
+  # Per app, so that building another app does not rewire this one.
+  broker = make_broker(app.config['CHAT_BROKER'])
+  broker.subscribe(deliver)
+  app.extensions['chat_broker'] = broker
+
+
+def is_participant(room_id, user_id):
+  cursor = get_conn().execute("SELECT 1 FROM chat_rooms WHERE session_id = (%s) AND (user_a = (%s) OR user_b = (%s))",
+                              room_id, user_id, user_id)
+  found = cursor.fetchone() is not None
+  cursor.close()
+  return found
+
+
+@socketio.on('connect')
+def on_connect():
+  if 'loggedin' not in session:
+    return False
+  join_room(user_room(session['user_id']))
+
+
+@socketio.on('join')
+def on_join(data):
+  user_id = session.get('user_id')
+  room_id = (data or {}).get('rid')
+  if not user_id or not room_id or not is_participant(room_id, user_id):
+    return
+  old_room = presence.leave(request.sid)
+  if old_room is not None and old_room != room_id:
+    leave_room(old_room)
+    emit('presence', {'room_id': old_room, 'users': presence.present(old_room)}, to=old_room)
+  join_room(room_id)
+  presence.join(request.sid, user_id, room_id)
+  emit('presence', {'room_id': room_id, 'users': presence.present(room_id)}, to=room_id)
+
+
+@socketio.on('disconnect')
+def on_disconnect():
+  room_id = presence.leave(request.sid)
+  if room_id is not None:
+    emit('presence', {'room_id': room_id, 'users': presence.present(room_id)}, to=room_id)
@@ -0,0 +1,125 @@
+"""
+Product reviews and their per-product summaries.
+
+review_summaries (migration 0007) keeps each product's thumbs-up count and
+review total. Adding or removing a review updates its product's row in the
+same transaction, so a rating is one primary-key lookup instead of two
+COUNT queries over review_posts. recompute() rebuilds rows from
+review_posts if they ever drift (manage.py recompute-review-summaries).
+
+Item pages list reviews a page at a time, newest first, with a
+(posted_at, review_id) keyset; the photos of a whole page come from one
+more query.
+"""
+from db import decode_cursor, encode_cursor, transaction
+
+
+def add_review(conn, review_id, review_type, reviewer, product_number):
+  up = 1 if review_type == 'thumbs up' else 0
+  with transaction(conn):
+    conn.execute("INSERT INTO review_posts (review_id, review_type, reviewer, reviewed_product) VALUES (%s,%s,%s,%s)",
+                 review_id, review_type, reviewer, product_number)
+    conn.execute("""
+      INSERT INTO review_summaries AS S (product_number, up_count, total) VALUES (%s, %s, 1)
+      ON CONFLICT (product_number) DO UPDATE SET up_count = S.up_count + EXCLUDED.up_count, total = S.total + 1""",
+      product_number, up)
+
+
+def remove_review(conn, review_id, reviewer):
+  """Delete one of reviewer's reviews and take it out of its product's summary."""
+  with transaction(conn):
+    conn.execute("""
+      WITH gone AS (
+        DELETE FROM review_posts WHERE review_id = (%s) AND reviewer = (%s)
+        RETURNING reviewed_product, review_type
+      )
+      UPDATE review_summaries S
+      SET up_count = S.up_count - (CASE WHEN gone.review_type = 'thumbs up' THEN 1 ELSE 0 END),
+          total = S.total - 1
+      FROM gone WHERE S.product_number = gone.reviewed_product""", review_id, reviewer)
+
+
+def load_rating(conn, product_number):
+  """Percentage of thumbs-up reviews of a product, or None if it has none."""
+  cursor = conn.execute("SELECT up_count, total FROM review_summaries WHERE product_number = (%s)", product_number)
+  row = cursor.fetchone()
+  cursor.close()
+  if row is None or not row['total']:
+    return None
+  return row['up_count'] * 100.0 / row['total']
+
+
+def load_reviews(conn, product_number, before=None, limit=20):
+  """
+  One page of a product's reviews with the reviewer's name, newest first,
+  starting after the cursor `before`. Returns (reviews, photos,
+  next_cursor): photos maps review_id to its photo_ids, and next_cursor is
+  None on the last page.
+  """
+  params = [product_number]
+  keyset = ''
+  position = decode_cursor(before)
+  if position:
+    keyset = "AND (R.posted_at, R.review_id) < (%s, %s)"
+    params.extend(position)
+  params.append(limit + 1)
+  cursor = conn.execute("""
+    SELECT R.review_id, R.review_type, R.reviewer, R.posted_at, U.name
+    FROM review_posts R JOIN users U ON U.user_id = R.reviewer
+    WHERE R.reviewed_product = (%s) {keyset}
+    ORDER BY R.posted_at DESC, R.review_id DESC
+    LIMIT %s""".format(keyset=keyset), *params)
+  reviews = cursor.fetchall()
+  cursor.close()
+
+  next_cursor = None
+  if len(reviews) > limit:
+    reviews = reviews[:limit]
+    next_cursor = encode_cursor(reviews[-1]['posted_at'], reviews[-1]['review_id'])
+
+  photos = {}
+  if reviews:
+    # Named parameters: a list among positional ones is read as many rows
+    # of parameters; psycopg2 sends this one as an array.
+    cursor = conn.execute("""
+      SELECT review_id, photo_id FROM include_photo
+      WHERE review_id = ANY(%(review_ids)s)
+      ORDER BY review_id, photo_id""", {'review_ids': [review['review_id'] for review in reviews]})
+    for row in cursor:
+      photos.setdefault(row['review_id'], []).append(row['photo_id'])
+    cursor.close()
+  return reviews, photos, next_cursor
+
+
+def recompute(conn, product_numbers=None):
+  """
+  Rewrite review_summaries from review_posts, for the given products or for
+  all of them. Returns the number of rows that were wrong.
+  """
+  scope = ''
+  params = {}
+  if product_numbers:
+    scope = "WHERE P.product_number = ANY(%(product_numbers)s)"
+    params['product_numbers'] = list(product_numbers)
+  with transaction(conn):
+    cursor = conn.execute("""
+      WITH actual AS (
+        SELECT P.product_number,
+               COUNT(R.review_id) FILTER (WHERE R.review_type = 'thumbs up') AS up_count,
+               COUNT(R.review_id) AS total
+        FROM products P LEFT JOIN review_posts R ON R.reviewed_product = P.product_number
+        {scope}
+        GROUP BY P.product_number
+      ),
+      fixed AS (
+        INSERT INTO review_summaries AS S (product_number, up_count, total)
+        SELECT product_number, up_count, total FROM actual
+        WHERE total > 0 OR product_number IN (SELECT product_number FROM review_summaries)
+        ON CONFLICT (product_number) DO UPDATE SET up_count = EXCLUDED.up_count, total = EXCLUDED.total
+        WHERE (S.up_count, S.total) IS DISTINCT FROM (EXCLUDED.up_count, EXCLUDED.total)
+        RETURNING 1
+      )
+      SELECT COUNT(*) FROM fixed""".format(scope=scope), params)
+    fixed = cursor.scalar()
+    cursor.close()
+  return fixed
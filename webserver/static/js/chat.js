@@ -0,0 +1,124 @@
+// Live delivery: messages for the open room arrive over Socket.IO and
+// the form posts in the background instead of reloading the page.
+// chat.html puts the open room and the user on .messaging; the script is
+// deferred, so the page is parsed by the time it runs.
+let messaging = document.querySelector('.messaging');
+let roomId = messaging.dataset.roomId;
+let userId = messaging.dataset.userId;
+let socket = io();
+let msgHistory = document.querySelector('.msg_history');
+
+let lastId = 0;
+msgHistory.querySelectorAll('[data-message-id]').forEach((el) => {
+  lastId = Math.max(lastId, Number(el.dataset.messageId));
+});
+
+let renderMessage = (m) => {
+  let outgoing = m.sender === userId;
+  let wrapper = document.createElement('div');
+  wrapper.className = outgoing ? 'outgoing_msg' : 'incoming_msg';
+  wrapper.dataset.messageId = m.message_id;
+  let body = document.createElement('div');
+  body.className = outgoing ? 'sent_msg' : 'received_withd_msg';
+  let content = document.createElement('p');
+  content.textContent = m.content;
+  let date = document.createElement('span');
+  date.className = 'time_date';
+  date.textContent = m.date_time;
+  body.append(content, date);
+  if (outgoing) {
+    wrapper.append(body);
+  } else {
+    let received = document.createElement('div');
+    received.className = 'received_msg';
+    received.append(body);
+    wrapper.append(received);
+  }
+  return wrapper;
+}
+
+let appendMessage = (m) => {
+  if (m.message_id <= lastId) {
+    return;
+  }
+  lastId = m.message_id;
+  msgHistory.append(renderMessage(m));
+  msgHistory.scrollTop = msgHistory.scrollHeight;
+}
+
+let messagesUrl = (params) => '/chat/' + encodeURIComponent(roomId) + '/messages?' + params;
+
+// Scrolling to the top loads the previous page of the conversation.
+let loadingOlder = false;
+msgHistory.addEventListener('scroll', () => {
+  let older = msgHistory.dataset.older;
+  if (!roomId || !older || loadingOlder || msgHistory.scrollTop > 0) {
+    return;
+  }
+  loadingOlder = true;
+  fetch(messagesUrl('before=' + older)).then((r) => r.json()).then((page) => {
+    let height = msgHistory.scrollHeight;
+    page.messages.slice().reverse().forEach((m) => msgHistory.prepend(renderMessage(m)));
+    msgHistory.dataset.older = page.older === null ? '' : page.older;
+    msgHistory.scrollTop = msgHistory.scrollHeight - height;
+    loadingOlder = false;
+  });
+});
+
+// Without a socket connection, fetch only what arrived since lastId.
+setInterval(() => {
+  if (!roomId || socket.connected) {
+    return;
+  }
+  fetch(messagesUrl('since=' + lastId)).then((r) => r.json()).then((page) => {
+    page.messages.forEach(appendMessage);
+  });
+}, 5000);
+
+socket.on('connect', () => {
+  if (roomId) {
+    socket.emit('join', {rid: roomId});
+  }
+});
+socket.on('message', (m) => {
+  if (m.room_id === roomId) {
+    appendMessage(m);
+  }
+});
+socket.on('inbox', (m) => {
+  let preview = document.querySelector('[id="' + m.room_id + '"] #last-message');
+  if (preview) {
+    preview.textContent = m.content;
+  }
+});
+socket.on('presence', (p) => {
+  let others = p.users.filter((u) => u !== userId);
+  document.querySelector('#presence').textContent = others.length ? 'online' : '';
+});
+
+let chatForm = document.querySelector('#chat_form');
+chatForm.addEventListener('submit', (e) => {
+  if (!roomId) {
+    return;
+  }
+  e.preventDefault();
+  let data = new FormData(chatForm);
+  chatForm.querySelector('.message').value = '';
+  fetch(chatForm.action, {method: 'POST', body: data, headers: {'X-Requested-With': 'XMLHttpRequest'}});
+});
+
+let newChatBtn = document.querySelector('#new_chat_btn');
+let newChatForm = document.querySelector('#new_chat_form');
+let newChatoverlay = document.querySelector('#new_chat_overlay');
+newChatBtn.onclick = (e) => {
+  if (e.target === newChatBtn) {
+    newChatForm.style.display = "block";
+    newChatoverlay.style.display = 'block';
+  }
+}
+newChatoverlay.onclick = (e) => {
+  if (e.target === newChatoverlay) {
+    newChatForm.style.display = "none";
+    newChatoverlay.style.display = 'none';
+  }
+}
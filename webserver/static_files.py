@@ -0,0 +1,112 @@
+"""
+Static file serving with fingerprinted URLs.
+
+url_for('static', filename=...) adds ?v=<hash of the file's contents>, so
+a URL names exactly one version of a file. A request whose v matches the
+file on disk is answered with a year-long, immutable Cache-Control; any
+other request (no v, or a stale one) is revalidated every time. Every
+response carries the content hash as its ETag and supports conditional
+GET and Range requests (through send_file).
+
+Files without an extension (the product images are named by
+product_number) get their type from their first bytes instead of being
+guessed as text.
+
+With STATIC_X_SENDFILE on, the file body is left to the front web server
+(X-Sendfile, as understood by Apache's mod_xsendfile and lighttpd).
+Otherwise send_file hands the open file to the WSGI server's file
+wrapper, which gunicorn streams with sendfile().
+"""
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import abort, current_app, request, send_file
+from werkzeug.security import safe_join
+
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Leading bytes of the image formats we serve, for extensionless files.
+SIGNATURES = [
+  (b'\x89PNG\r\n\x1a\n', 'image/png'),
+  (b'\xff\xd8\xff', 'image/jpeg'),
+  (b'GIF87a', 'image/gif'),
+  (b'GIF89a', 'image/gif'),
+]
+
+_lock = threading.Lock()
+# (path, mtime, size) -> (sha1, mimetype), so a file is read once per change
+_files = {}
+
+
+def sniff(head):
+  for signature, mimetype in SIGNATURES:
+    if head.startswith(signature):
+      return mimetype
+  if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+    return 'image/webp'
+  return 'application/octet-stream'
+
+
+def describe(path):
+  """(content hash, mimetype) of the file at path."""
+  stat = os.stat(path)
+  key = (path, stat.st_mtime, stat.st_size)
+  value = _files.get(key)
+  if value is None:
+    with open(path, 'rb') as f:
+      data = f.read()
+    mimetype = mimetypes.guess_type(path)[0] if os.path.splitext(path)[1] else None
+    value = (hashlib.sha1(data).hexdigest(), mimetype or sniff(data[:16]))
+    with _lock:
+      _files[key] = value
+  return value
+
+
+def file_digest(path):
+  return describe(path)[0]
+
+
+def fingerprint(path):
+  """The short content hash put in URLs."""
+  return file_digest(path)[:12]
+
+
+def send_fingerprinted(path, version=None, mimetype=None):
+  """
+  send_file for a file whose URL may carry ?v=<version> (by default its
+  fingerprint): immutable for a year when v is current, revalidated
+  otherwise.
+  """
+  digest, sniffed = describe(path)
+  immutable = request.args.get('v') == (version or digest[:12])
+  response = send_file(path, mimetype=mimetype or sniffed, etag=digest, conditional=True,
+                       max_age=IMMUTABLE_MAX_AGE if immutable else 0)
+  if immutable:
+    response.cache_control.immutable = True
+  else:
+    response.cache_control.no_cache = True
+  return response
+
+
+def serve_static(filename):
+  path = safe_join(current_app.static_folder, filename.lstrip('/'))
+  if path is None or not os.path.isfile(path):
+    abort(404)
+  return send_fingerprinted(path)
+
+
+def add_fingerprint(endpoint, values):
+  if endpoint != 'static' or 'v' in values:
+    return
+  path = safe_join(current_app.static_folder, values.get('filename', '').lstrip('/'))
+  if path is not None and os.path.isfile(path):
+    values['v'] = fingerprint(path)
+
+
+def init_app(app):
+  app.config['USE_X_SENDFILE'] = app.config['STATIC_X_SENDFILE']
+  app.url_defaults(add_fingerprint)
+  app.view_functions['static'] = serve_static
@@ -0,0 +1,65 @@
+"""
+Template compilation.
+
+Jinja compiles a template to Python the first time a worker renders it,
+which puts the compile on some user's request in every new worker. Here:
+
+- compiled templates are kept in a bytecode cache on disk
+  (TEMPLATE_CACHE_DIR, by default templates/ in the instance folder),
+  shared by every worker on the machine, so a template is compiled once
+  per change of its source rather than once per worker. Jinja loads the
+  cached code without checking it, so the directory must be private to
+  the user the app runs as: it is created with mode 0700, and startup
+  fails if it belongs to someone else or others can write to it;
+- with TEMPLATE_PRECOMPILE on, create_app() loads every template up front,
+  from that cache when it is warm; `manage.py compile-templates` fills it
+  at deploy;
+- with TEMPLATES_AUTO_RELOAD off (Flask's setting; it follows debug when
+  unset) Jinja no longer stats the source file on every render to see
+  whether it changed. Production should turn it off and restart workers
+  to pick up new templates.
+"""
+import os
+import stat
+import tempfile
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+  """A FileSystemBytecodeCache whose writes other workers never see half done."""
+
+  def dump_bytecode(self, bucket):
+    fd, tmp = tempfile.mkstemp(dir=self.directory)
+    with os.fdopen(fd, 'wb') as f:
+      bucket.write_bytecode(f)
+    os.replace(tmp, self._get_cache_filename(bucket))
+
+
+def private_dir(path):
+  """Create path for this user only, or check that an existing one is; returns path."""
+  os.makedirs(path, mode=0o700, exist_ok=True)
+  st = os.lstat(path)
+  if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+    raise RuntimeError("%s must be a directory owned by this user with mode 0700" % path)
+  return path
+
+
+def precompile(app):
+  """Load every template into the Jinja environment; returns their names."""
+  env = app.jinja_env
+  names = env.list_templates(extensions=['html'])
+  for name in names:
+    env.get_template(name)
+  return names
+
+
+def init_app(app):
+  """Call after the extensions that add to app.jinja_env (see assets.py)."""
+  cache_dir = app.config['TEMPLATE_CACHE_DIR']
+  if cache_dir is None:
+    cache_dir = os.path.join(app.instance_path, 'templates')
+  if cache_dir:
+    app.jinja_env.bytecode_cache = SharedBytecodeCache(private_dir(cache_dir))
+  if app.config['TEMPLATE_PRECOMPILE']:
+    precompile(app)
@@ -0,0 +1,70 @@
+"""
+The navigation facets: reloaded on a timer, and served from the last good
+copy while the database is failing.
+"""
+import contextlib
+
+import pytest
+from flask import Flask
+
+import catalog
+
+
+class FakeEngine(object):
+
+  def connect(self):
+    return contextlib.nullcontext()
+
+
+@pytest.fixture
+def app(monkeypatch):
+  monkeypatch.setattr(catalog, '_facets', None)
+  monkeypatch.setattr(catalog, '_facets_expires', 0.0)
+  monkeypatch.setattr(catalog, 'get_engine', FakeEngine)
+  app = Flask(__name__)
+  app.config['CATALOG_FACETS_TTL'] = 300
+  with app.app_context():
+    yield app
+
+
+def loads(monkeypatch, *results):
+  """Make load_facets return (or raise) each of results in turn; returns the call count."""
+  calls = []
+
+  def load_facets(conn):
+    result = results[len(calls)]
+    calls.append(result)
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+  monkeypatch.setattr(catalog, 'load_facets', load_facets)
+  return calls
+
+
+def test_no_database_gives_empty_menus(app, monkeypatch):
+  calls = loads(monkeypatch, RuntimeError('no database'))
+  assert catalog.facets() == catalog.no_facets
+  # Not retried on every page until the interval has passed.
+  assert catalog.facets() == catalog.no_facets
+  assert len(calls) == 1
+
+
+def test_loaded_once_per_interval(app, monkeypatch):
+  first = {'categories': ['book'], 'brands': []}
+  calls = loads(monkeypatch, first)
+  assert catalog.facets() is first
+  assert catalog.facets() is first
+  assert len(calls) == 1
+
+
+def test_failed_reload_keeps_last_copy(app, monkeypatch):
+  first = {'categories': ['book'], 'brands': []}
+  second = {'categories': ['book', 'toy'], 'brands': []}
+  calls = loads(monkeypatch, first, RuntimeError('database down'), second)
+  assert catalog.facets() is first
+  monkeypatch.setattr(catalog, '_facets_expires', 0.0)
+  assert catalog.facets() is first
+  monkeypatch.setattr(catalog, '_facets_expires', 0.0)
+  assert catalog.facets() is second
+  assert len(calls) == 3
@@ -0,0 +1,57 @@
+"""
+IdAllocator under many threads, with an in-process counter standing in for
+the block sequences' nextval().
+"""
+import itertools
+import threading
+
+import pytest
+
+from ids import BLOCK_SIZE, IdAllocator
+
+
+def sequence(block_size):
+  """A reserve() that steps by block_size like the migrated sequences; returns it and its calls."""
+  values = itertools.count(block_size, block_size)
+  calls = []
+
+  def reserve(name):
+    calls.append(name)
+    return next(values)
+
+  return reserve, calls
+
+
+@pytest.mark.parametrize('prefix, width, block_size', [
+  ('u', 7, BLOCK_SIZE),
+  ('p', 10, BLOCK_SIZE),
+  ('r', 7, 7),
+  ('c', 10, 1),
+])
+def test_threads_never_share_an_id(prefix, width, block_size):
+  threads, per_thread = 16, 2000
+  reserve, calls = sequence(block_size)
+  allocator = IdAllocator(prefix, width, 'blocks', block_size=block_size, reserve=reserve)
+  results = [None] * threads
+
+  def work(i):
+    results[i] = [allocator.next_id() for _ in range(per_thread)]
+
+  workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+  for w in workers:
+    w.start()
+  for w in workers:
+    w.join()
+
+  allocated = [id for chunk in results for id in chunk]
+  assert len(allocated) == threads * per_thread
+  assert len(set(allocated)) == len(allocated)
+  assert all(len(id) == width and id.startswith(prefix) for id in allocated)
+  # One nextval() per block, each block used up before the next is taken.
+  assert len(calls) == -(-len(allocated) // block_size)
+
+
+def test_block_starts_at_the_reserved_number():
+  allocator = IdAllocator('u', 7, 'blocks', block_size=1000, reserve=lambda name: 36 * 1000)
+  assert allocator.next_id() == 'u000rs0'
+  assert allocator.next_id() == 'u000rs1'
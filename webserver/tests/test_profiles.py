@@ -0,0 +1,85 @@
+"""
+The profile page's queries, counted against a fake connection: the number
+per GET /profile must not grow with the number of users followed.
+"""
+import pytest
+
+import catalog
+import server
+
+
+class FakeCursor(object):
+
+  def __init__(self, rows):
+    self.rows = rows
+
+  def fetchone(self):
+    return self.rows[0] if self.rows else None
+
+  def fetchall(self):
+    return list(self.rows)
+
+  def close(self):
+    pass
+
+
+class CountingConnection(object):
+  """Answers every query from canned rows and counts the queries."""
+
+  def __init__(self, friends):
+    self.friends = friends
+    self.queries = 0
+
+  def execute(self, sql, *params):
+    self.queries += 1
+    if 'connected_to' in sql:
+      # (user_id, [after,] limit), as load_friends() passes them.
+      friends = self.friends
+      if len(params) == 3:
+        friends = [friend for friend in friends if friend['username'] > params[1]]
+      return FakeCursor(friends[:params[-1]])
+    if 'lives_at' in sql:
+      return FakeCursor([{'street_1': '1 Main St', 'street_2': None, 'city': 'New York', 'state': 'NY', 'zip': '10027'}])
+    return FakeCursor([{'user_id': 'u1', 'username': 'alice', 'name': 'Alice', 'email': 'alice@example.com'}])
+
+
+@pytest.fixture
+def client(monkeypatch):
+  app = server.app
+  monkeypatch.setitem(app.config, 'FRAGMENT_CACHE', 'off')
+  monkeypatch.setitem(app.config, 'FRIENDS_PAGE_SIZE', 50)
+  # The navigation menus read their own connection; give them a fresh copy.
+  monkeypatch.setattr(catalog, '_facets', catalog.no_facets)
+  monkeypatch.setattr(catalog, '_facets_expires', float('inf'))
+  client = app.test_client()
+  with client.session_transaction() as session:
+    session['loggedin'] = True
+    session['user_id'] = 'u1'
+    session['username'] = 'alice'
+  return client
+
+
+def get_profile(client, monkeypatch, count, after=None):
+  """GET /profile following count users; returns (connection, page HTML)."""
+  friends = [{'user_id': 'f%04d' % i, 'username': 'user%04d' % i} for i in range(count)]
+  conn = CountingConnection(friends)
+  monkeypatch.setattr(server, 'get_conn', lambda: conn)
+  response = client.get('/profile', query_string={'after': after} if after else None)
+  assert response.status_code == 200
+  return conn, response.get_data(as_text=True)
+
+
+@pytest.mark.parametrize('count', [0, 1, 10, 49, 50, 51, 1000])
+def test_profile_query_count_is_constant(client, monkeypatch, count):
+  conn, html = get_profile(client, monkeypatch, count)
+  assert conn.queries == 3
+  assert html.count('name="user" value="user') == min(count, 50)
+  assert ('after=user0049' in html) == (count > 50)
+
+
+def test_next_page_costs_the_same(client, monkeypatch):
+  conn, html = get_profile(client, monkeypatch, 1000, after='user0049')
+  assert conn.queries == 3
+  assert 'value="user0049"' not in html
+  assert 'value="user0050"' in html
+  assert 'after=user0099' in html
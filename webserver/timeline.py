@@ -0,0 +1,310 @@
+"""
+Optional fan-out-on-write feed (FEED_MODE = 'push').
+
+Instead of sorting posts across every connection at read time, each post is
+pushed into the precomputed timeline of its author and of everyone who
+follows the author when it is written. /home then reads the first page of
+the user's own timeline directly.
+
+  - /posts pushes the new post (public posts to followers, private posts
+    only to the author).
+  - /delpost retracts the post from every timeline that holds it.
+  - /unfollow retracts the unfollowed author's posts from the follower's
+    timeline; /requestadd drops it so it is rebuilt with the new author.
+
+Timelines are bounded to TIMELINE_MAX_LENGTH entries. A timeline that
+does not exist yet (new user, restarted worker, dropped by /requestadd) is
+filled from the pull query on first read, and pages older than the
+bounded window also fall back to the pull query.
+
+Two stores are provided: SQLiteTimelineStore (the default) keeps them in a
+local SQLite file that every worker on the host shares, and
+MemoryTimelineStore keeps timelines in this process only. Writes reach
+only the store of the worker that made them, so the memory store is
+refused when WEB_CONCURRENCY > 1. Posts read from the SQLite file go
+straight into users' feeds, so it is kept in a directory private to the
+app's user (timelines/ in the instance folder by default); init_app()
+checks both at startup.
+"""
+import bisect
+import json
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from datetime import date, datetime
+
+from flask import current_app
+
+from db import decode_cursor, encode_cursor
+from feed import load_feed
+from templating import private_dir
+
+
+def sort_key(post):
+  return (post['date_time'].isoformat(), post['post_id'])
+
+
+class MemoryTimelineStore(object):
+  """Per-process timelines: user_id -> posts sorted oldest first."""
+
+  def __init__(self, max_length):
+    self.max_length = max_length
+    self.lock = threading.Lock()
+    self.timelines = {}
+    # post_id -> user_ids whose timeline holds it, for retraction
+    self.holders = defaultdict(set)
+
+  def exists(self, user_id):
+    return user_id in self.timelines
+
+  def user_ids(self):
+    return list(self.timelines)
+
+  def length(self, user_id):
+    return len(self.timelines.get(user_id, ()))
+
+  def fill(self, user_id, posts):
+    with self.lock:
+      self._drop(user_id)
+      entries = sorted((sort_key(p), p) for p in posts)[-self.max_length:]
+      self.timelines[user_id] = entries
+      for key, post in entries:
+        self.holders[post['post_id']].add(user_id)
+
+  def push(self, user_ids, post):
+    """Insert post into the given timelines (only those already built)."""
+    key = sort_key(post)
+    with self.lock:
+      for user_id in user_ids:
+        entries = self.timelines.get(user_id)
+        # Already there if a concurrent fill() read it from the database.
+        if entries is None or user_id in self.holders[post['post_id']]:
+          continue
+        bisect.insort(entries, (key, post))
+        self.holders[post['post_id']].add(user_id)
+        while len(entries) > self.max_length:
+          old_key, old = entries.pop(0)
+          self.holders[old['post_id']].discard(user_id)
+
+  def retract(self, post_id):
+    with self.lock:
+      for user_id in self.holders.pop(post_id, ()):
+        entries = self.timelines.get(user_id)
+        if entries is not None:
+          self.timelines[user_id] = [e for e in entries if e[1]['post_id'] != post_id]
+
+  def retract_author(self, user_id, author_id):
+    with self.lock:
+      entries = self.timelines.get(user_id)
+      if entries is None:
+        return
+      keep = []
+      for key, post in entries:
+        if post['user_id'] == author_id:
+          self.holders[post['post_id']].discard(user_id)
+        else:
+          keep.append((key, post))
+      self.timelines[user_id] = keep
+
+  def drop(self, user_id):
+    with self.lock:
+      self._drop(user_id)
+
+  def _drop(self, user_id):
+    for key, post in self.timelines.pop(user_id, ()):
+      self.holders[post['post_id']].discard(user_id)
+
+  def read(self, user_id, before=None, limit=20):
+    """
+    Up to limit posts, newest first, strictly older than before, a
+    (date_time, post_id) position as returned by db.decode_cursor().
+    """
+    with self.lock:
+      entries = self.timelines.get(user_id, [])
+      end = len(entries)
+      if before:
+        end = bisect.bisect_left(entries, (tuple(before),))
+      return [post for key, post in reversed(entries[max(0, end - limit):end])]
+
+
+def parse_date_time(value):
+  if 'T' in value:
+    return datetime.fromisoformat(value)
+  return date.fromisoformat(value)
+
+
+class SQLiteTimelineStore(object):
+  """Timelines in a local SQLite file shared by every worker on the host."""
+
+  def __init__(self, path, max_length):
+    self.path = path
+    self.max_length = max_length
+    self.local = threading.local()
+    conn = self.connect()
+    conn.executescript("""
+      PRAGMA journal_mode = WAL;
+      CREATE TABLE IF NOT EXISTS timelines (user_id TEXT PRIMARY KEY);
+      CREATE TABLE IF NOT EXISTS timeline_entries (
+        user_id TEXT,
+        date_key TEXT,
+        post_id TEXT,
+        author_id TEXT,
+        post TEXT,
+        PRIMARY KEY (user_id, date_key, post_id)
+      ) WITHOUT ROWID;
+      CREATE INDEX IF NOT EXISTS timeline_entries_post_idx ON timeline_entries (post_id);
+    """)
+
+  def connect(self):
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+      self.local.conn = conn
+    return conn
+
+  def exists(self, user_id):
+    row = self.connect().execute("SELECT 1 FROM timelines WHERE user_id = ?", (user_id,)).fetchone()
+    return row is not None
+
+  def length(self, user_id):
+    return self.connect().execute("SELECT COUNT(*) FROM timeline_entries WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+  def rows(self, user_id, posts):
+    for post in posts:
+      stored = dict(post, date_time=post['date_time'].isoformat())
+      yield (user_id, stored['date_time'], post['post_id'], post['user_id'], json.dumps(stored))
+
+  def trim(self, conn, user_id):
+    conn.execute("""DELETE FROM timeline_entries WHERE user_id = ? AND (date_key, post_id) IN (
+                      SELECT date_key, post_id FROM timeline_entries WHERE user_id = ?
+                      ORDER BY date_key DESC, post_id DESC LIMIT -1 OFFSET ?)""", (user_id, user_id, self.max_length))
+
+  def fill(self, user_id, posts):
+    conn = self.connect()
+    with conn:
+      conn.execute("BEGIN IMMEDIATE")
+      conn.execute("DELETE FROM timeline_entries WHERE user_id = ?", (user_id,))
+      conn.execute("INSERT OR IGNORE INTO timelines VALUES (?)", (user_id,))
+      conn.executemany("INSERT OR REPLACE INTO timeline_entries VALUES (?, ?, ?, ?, ?)", self.rows(user_id, posts))
+      self.trim(conn, user_id)
+
+  def push(self, user_ids, post):
+    conn = self.connect()
+    with conn:
+      conn.execute("BEGIN IMMEDIATE")
+      for user_id in user_ids:
+        if conn.execute("SELECT 1 FROM timelines WHERE user_id = ?", (user_id,)).fetchone() is None:
+          continue
+        conn.executemany("INSERT OR REPLACE INTO timeline_entries VALUES (?, ?, ?, ?, ?)", self.rows(user_id, [post]))
+        self.trim(conn, user_id)
+
+  def retract(self, post_id):
+    self.connect().execute("DELETE FROM timeline_entries WHERE post_id = ?", (post_id,))
+
+  def retract_author(self, user_id, author_id):
+    self.connect().execute("DELETE FROM timeline_entries WHERE user_id = ? AND author_id = ?", (user_id, author_id))
+
+  def drop(self, user_id):
+    conn = self.connect()
+    with conn:
+      conn.execute("BEGIN IMMEDIATE")
+      conn.execute("DELETE FROM timeline_entries WHERE user_id = ?", (user_id,))
+      conn.execute("DELETE FROM timelines WHERE user_id = ?", (user_id,))
+
+  def read(self, user_id, before=None, limit=20):
+    sql = "SELECT post FROM timeline_entries WHERE user_id = ?"
+    params = [user_id]
+    if before:
+      sql += " AND (date_key, post_id) < (?, ?)"
+      params.extend(before)
+    sql += " ORDER BY date_key DESC, post_id DESC LIMIT ?"
+    params.append(limit)
+    posts = []
+    for (stored,) in self.connect().execute(sql, params):
+      post = json.loads(stored)
+      post['date_time'] = parse_date_time(post['date_time'])
+      posts.append(post)
+    return posts
+
+  def user_ids(self):
+    return [row[0] for row in self.connect().execute("SELECT user_id FROM timelines")]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+  """This process's timeline store, or None when FEED_MODE is 'pull'."""
+  global _store
+  config = current_app.config
+  if config['FEED_MODE'] != 'push':
+    return None
+  if _store is None:
+    with _store_lock:
+      if _store is None:
+        if config['TIMELINE_STORE'] == 'sqlite':
+          _store = SQLiteTimelineStore(config['TIMELINE_SQLITE_PATH'], config['TIMELINE_MAX_LENGTH'])
+        else:
+          _store = MemoryTimelineStore(config['TIMELINE_MAX_LENGTH'])
+  return _store
+
+
+def init_app(app):
+  """Check the store settings, so a bad deploy fails to boot instead of failing every /home."""
+  config = app.config
+  if config['FEED_MODE'] != 'push':
+    return
+  if config['TIMELINE_STORE'] == 'sqlite':
+    if not config['TIMELINE_SQLITE_PATH']:
+      config['TIMELINE_SQLITE_PATH'] = os.path.join(app.instance_path, 'timelines', 'timelines.sqlite3')
+    private_dir(os.path.dirname(os.path.abspath(config['TIMELINE_SQLITE_PATH'])))
+  elif config['WEB_CONCURRENCY'] > 1:
+    raise ValueError("TIMELINE_STORE='memory' is per process; use 'sqlite' with WEB_CONCURRENCY > 1")
+
+
+def read_feed(conn, store, user_id, before=None, limit=20):
+  """Same contract as feed.load_feed(), served from the materialized timeline."""
+  if not store.exists(user_id):
+    posts, _ = load_feed(conn, user_id, limit=store.max_length)
+    store.fill(user_id, posts)
+
+  posts = store.read(user_id, before=decode_cursor(before), limit=limit + 1)
+  if len(posts) <= limit and store.length(user_id) >= store.max_length:
+    # Past the bounded window: older history may have been trimmed.
+    return load_feed(conn, user_id, before=before, limit=limit)
+
+  next_cursor = None
+  if len(posts) > limit:
+    posts = posts[:limit]
+    next_cursor = encode_cursor(posts[-1]['date_time'], posts[-1]['post_id'])
+  return posts, next_cursor
+
+
+def followers(conn, user_id):
+  cursor = conn.execute("SELECT user_id FROM connected_to WHERE connection = (%s)", user_id)
+  ids = [row['user_id'] for row in cursor]
+  cursor.close()
+  return ids
+
+
+def fan_out(conn, store, post):
+  """Push a freshly written post to its author and, if public, their followers."""
+  targets = [post['user_id']]
+  if post['privacy_type'] == 'public':
+    targets.extend(followers(conn, post['user_id']))
+  store.push(targets, post)
+
+
+def check(conn, store, user_id):
+  """
+  Compare a materialized timeline with the pull query over the same window.
+  Returns (missing, extra): post ids the timeline lacks, and post ids it
+  holds that the pull model would not show.
+  """
+  expected, _ = load_feed(conn, user_id, limit=store.max_length)
+  actual = store.read(user_id, limit=store.max_length)
+  expected_ids = set(p['post_id'] for p in expected)
+  actual_ids = set(p['post_id'] for p in actual)
+  return sorted(expected_ids - actual_ids), sorted(actual_ids - expected_ids)